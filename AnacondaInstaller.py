@@ -67,16 +67,15 @@ def use_anaconda_prefix(installation_path):
 def currently_installed_packages(installation_path):
     installation_path = os.path.abspath(installation_path)
     packages = set()
-    conda_list = utils.subprocess_check(
-        f'{use_anaconda_prefix(installation_path)} && conda list', 
+    # conda list and pip list are independent, so run them at the same time
+    (conda_list, pip_list) = utils.run_many([
+        f'{use_anaconda_prefix(installation_path)} && conda list',
+        f'{use_anaconda_prefix(installation_path)} && pip list'],
         executable='/bin/bash')
     for line in conda_list.split('\n'):
         line = line.strip()
         if line and line[0] != '#':
             packages.add(line.split()[0])
-    pip_list = utils.subprocess_check(
-        f'{use_anaconda_prefix(installation_path)} && pip list', 
-        executable='/bin/bash')
     for line in pip_list.split('\n')[2:]:
         line = line.strip()
         if line:
@@ -93,10 +92,10 @@ def test_installation(installation_path):
     uwsgi_path = os.path.join(installation_path, 'bin/uwsgi')
     installed = currently_installed_packages(installation_path)
     if 'uwsgi' in installed:
-        utils.subprocess_check([uwsgi_path, '--version'], verbose=True)
+        utils.subprocess_check([uwsgi_path, '--version'], verbose=True, stream=True)
     if 'geopandas' in installed:
         utils.subprocess_check(
-            f'{use_anaconda} && python -c "import geopandas"', verbose=True, executable='/bin/bash')
+            f'{use_anaconda} && python -c "import geopandas"', verbose=True, stream=True, executable='/bin/bash')
 
 def install(installation_path, packages=None, conda_list_filename=None, dry_run=False, force_conda_forge=False):
     installation_path = os.path.abspath(installation_path)
@@ -6,24 +6,12 @@ parser.add_argument('watchdirs', nargs='+', help='Directories in which to recurs
 args = parser.parse_args()
 
 
-def exec_ipynb(filename_or_url):
-    nb = (requests.get(filename_or_url).json() if re.match(r'https?:', filename_or_url) else json.load(open(filename_or_url)))
-    if(nb['nbformat'] >= 4):
-        src = [''.join(cell['source']) for cell in nb['cells'] if cell['cell_type'] == 'code']
-    else:
-        src = [''.join(cell['input']) for cell in nb['worksheets'][0]['cells'] if cell['cell_type'] == 'code']
-
-    tmpname = '/tmp/%s-%s-%d.py' % (os.path.basename(filename_or_url),
-                                    datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'),
-                                    os.getpid())
-    src = '\n\n\n'.join(src)
-    open(tmpname, 'w').write(src)
-    code = compile(src, tmpname, 'exec')
-    exec(code, globals())
-
 script_dir = os.path.dirname(__file__)
 
-exec_ipynb(script_dir + '/utils.ipynb')
+# Importing utils installs its notebook importer, which loads utils.ipynb (from this script's
+# directory, on sys.path) as the module utils_ipynb, with its code cached
+import utils
+from utils_ipynb import *
 python_path = sys.executable
 run_notebook_path = os.path.realpath(script_dir + '/run-notebook-2.py')
 dirs_to_watch = [os.path.realpath(dir) for dir in args.watchdirs]
@@ -81,7 +69,7 @@ inotify = subprocess.Popen([
         stdout=subprocess.PIPE)
 
 initial_notebooks = subprocess_check(['find'] + dirs_to_watch + ['-name', '*.autorun.ipynb'] ).strip().split('\n')
-initial_notebooks = [n in initial_notebooks if n] # remove blank lines, ugh
+initial_notebooks = [n for n in initial_notebooks if n] # remove blank lines, ugh
 log('Starting %d initial notebooks %s' % (len(initial_notebooks), initial_notebooks))
 
 for notebook in initial_notebooks:
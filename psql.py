@@ -1,16 +1,85 @@
-import datetime, io, psycopg2, re, time
+import datetime, io, itertools, os, psycopg2, psycopg2.extensions, psycopg2.pool, queue, re, threading, time, utils
 import numpy as np
 import pandas as pd
 
 class Psql:
-    class Stopwatch:
-        def __init__(self, db, name):
-            self.name = name
+    # utils.Stopwatch, logging through db.info, and recorded in a profile only if profiling is on
+    # (see utils.Stopwatch).  Names are fixed labels, so they aggregate in the profile;  with rows,
+    # the row count and rows/sec are reported alongside.
+    class Stopwatch(utils.Stopwatch):
+        def __init__(self, db, name, rows=None):
+            super().__init__(name)
             self.db = db
+            self.rows = rows
+        def report(self):
+            msg = f'{self.name} took {self.seconds:1f} seconds'
+            if self.rows is not None and self.seconds:
+                msg += f' ({self.rows} rows, {self.rows / self.seconds:.0f} rows/sec)'
+            self.db.info(msg)
+
+    # File-like reader of df for copy_expert.  A producer thread encodes chunk_rows rows at a
+    # time while COPY consumes earlier chunks, holding at most queue_chunks encoded chunks
+    # waiting, so memory is bounded by the chunk size rather than the size of df.
+    # Subclasses define _chunks to yield the encoded bytes.
+    class ChunkReader:
+        def __init__(self, df, chunk_rows=100000, queue_chunks=2):
+            self.df = df
+            self.chunk_rows = chunk_rows
+            self.encode_seconds = 0
+            self._queue = queue.Queue(queue_chunks)
+            self._chunk = b''
+            self._offset = 0
+            self._eof = False
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._produce, name='CsvChunkReader', daemon=True)
+            self._thread.start()
+
+        def _produce(self):
+            try:
+                start = time.time()
+                for chunk in self._chunks():
+                    self.encode_seconds += time.time() - start
+                    if not self._put(chunk):
+                        return
+                    start = time.time()
+                self._put(None)
+            except BaseException as e:
+                self._put(e)
+
+        # Returns False if the reader was closed (e.g. COPY failed) before there was room
+        def _put(self, item):
+            while not self._stopped.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        # Returns up to size bytes from the current chunk, or b'' at the end
+        def read(self, size=-1):
+            while self._offset == len(self._chunk) and not self._eof:
+                item = self._queue.get()
+                if isinstance(item, BaseException):
+                    raise item
+                if item is None:
+                    self._eof = True
+                else:
+                    (self._chunk, self._offset) = (item, 0)
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size)
+            data = self._chunk[self._offset:end]
+            self._offset = end
+            return data
+
+        def close(self):
+            self._stopped.set()
+            self._thread.join()
+
         def __enter__(self):
-            self.start = time.time()
-        def __exit__(self, type, value, traceback):
-            self.db.info(f'{self.name} took {time.time() - self.start:1f} seconds')
+            return self
+
+        def __exit__(self, type, value, tb):
+            self.close()
 
     class Transaction:
         def __init__(self, db, suppress_errors=False):
@@ -18,35 +87,243 @@ class Psql:
             self.suppress_errors = suppress_errors
         
         def __enter__(self):
-            if self.db._transaction_count == 0:
+            state = self.db._state
+            if state.transaction_count == 0:
                 #self.db.info('Starting transaction')
-                pass
-            self.db._transaction_count += 1
-            if not self.db._cur:
-                self.db._cur = self.db._con.cursor()
-            return self.db._cur
+                if self.db._pool:
+                    state.con = self.db._checkout()
+            state.transaction_count += 1
+            if not state.cur:
+                state.cur = state.con.cursor()
+            return state.cur
         
         def __exit__(self, type, value, tb):
-            self.db._transaction_count -= 1
-            if self.db._transaction_count == 0:
-                if tb is None:
-                    #self.db.info('Committing transaction')
-                    self.db._con.commit()
+            state = self.db._state
+            state.transaction_count -= 1
+            if state.transaction_count == 0:
+                try:
+                    if tb is None:
+                        #self.db.info('Committing transaction')
+                        state.con.commit()
+                    else:
+                        if not self.suppress_errors:
+                            self.db.error('Exception; rolling back transaction')
+                        state.con.rollback()
+                    state.cur.close()
+                finally:
+                    state.cur = None
+                    if self.db._pool:
+                        self.db._checkin(state.con)
+                        state.con = None
+
+    class CsvChunkReader(ChunkReader):
+        def _chunks(self):
+            # Header on the first chunk only (COPY ... CSV header skips one line)
+            for start in range(0, max(len(self.df), 1), self.chunk_rows):
+                yield self.df.iloc[start:start + self.chunk_rows].to_csv(index=False, header=(start == 0)).encode()
+
+    # PostgreSQL binary COPY format, encoded a column at a time with NumPy.  pg_types are the
+    # table's column types, from pg_column_type.  Floats and datetimes that are NaN or NaT, and
+    # missing values in text columns, are written as NULL, as they are in CSV.
+    class BinaryChunkReader(ChunkReader):
+        pg_epoch = np.datetime64('2000-01-01T00:00:00', 'ns').astype('int64')
+
+        # Each encoder returns (width, bytes as an n x width uint8 array, null mask or None) for
+        # fixed-width types, or (None, concatenated bytes as a uint8 array, lengths) for text
+        fixed_encoders = {
+            'float8': lambda values: (8, values.astype('>f8'), np.isnan(values)),
+            'float4': lambda values: (4, values.astype('>f4'), np.isnan(values)),
+            'int8': lambda values: (8, values.astype('>i8'), None),
+            'int4': lambda values: (4, values.astype('>i4'), None),
+            'int2': lambda values: (2, values.astype('>i2'), None),
+            'bool': lambda values: (1, values.astype('u1'), None),
+            # days since 2000-01-01
+            'date': lambda values: (4, ((values.view('int64') - Psql.BinaryChunkReader.pg_epoch) // 86400000000000).astype('>i4'), np.isnat(values)),
+            # microseconds since 2000-01-01
+            'timestamp': lambda values: (8, ((values.view('int64') - Psql.BinaryChunkReader.pg_epoch) // 1000).astype('>i8'), np.isnat(values)),
+        }
+
+        def __init__(self, df, pg_types, chunk_rows=100000, queue_chunks=2):
+            for (col, pg_type) in zip(df.columns, pg_types):
+                if pg_type not in self.fixed_encoders and pg_type != 'text':
+                    raise Exception(f'No binary COPY encoding for column {col} of type {pg_type}; use format="csv"')
+            self.pg_types = pg_types
+            super().__init__(df, chunk_rows=chunk_rows, queue_chunks=queue_chunks)
+
+        def _chunks(self):
+            yield b'PGCOPY\n\xff\r\n\0' + np.array([0, 0], '>i4').tobytes()
+            for start in range(0, len(self.df), self.chunk_rows):
+                yield self._encode(self.df.iloc[start:start + self.chunk_rows])
+            yield np.array(-1, '>i2').tobytes()
+
+        def _encode_column(self, series, pg_type):
+            if pg_type == 'text':
+                nulls = series.isna().to_numpy()
+                encoded = [None if null else str(value).encode() for (value, null) in zip(series.to_numpy(), nulls)]
+                lengths = np.array([-1 if data is None else len(data) for data in encoded], 'int64')
+                data = np.frombuffer(b''.join(data for data in encoded if data is not None), 'u1')
+                return (None, data, lengths)
+            (width, values, nulls) = self.fixed_encoders[pg_type](series.to_numpy())
+            if nulls is not None and not nulls.any():
+                nulls = None
+            return (width, values.view('u1').reshape(len(series), width), nulls)
+
+        # Each row is a 16-bit field count, then for each field a 32-bit length (-1 for NULL)
+        # followed by that many bytes
+        def _encode(self, df):
+            n = len(df)
+            columns = [self._encode_column(df.iloc[:, i], pg_type) for (i, pg_type) in enumerate(self.pg_types)]
+            field_count = np.array([len(columns)], '>i2').view('u1')
+            if all(width is not None and nulls is None for (width, _, nulls) in columns):
+                # Every row has the same layout, so fill the columns of an n x row_size array
+                row_size = 2 + sum(4 + width for (width, _, _) in columns)
+                out = np.empty((n, row_size), 'u1')
+                out[:, 0:2] = field_count
+                offset = 2
+                for (width, values, _) in columns:
+                    out[:, offset:offset + 4] = np.array([width], '>i4').view('u1')
+                    out[:, offset + 4:offset + 4 + width] = values
+                    offset += 4 + width
+                return out.tobytes()
+
+            # Otherwise scatter each column's fields to their offsets within variable-sized rows
+            lengths = []  # of each field, -1 for NULL
+            for (width, _, nulls_or_lengths) in columns:
+                if width is None:
+                    lengths.append(nulls_or_lengths)
+                elif nulls_or_lengths is None:
+                    lengths.append(np.full(n, width))
                 else:
-                    if not self.suppress_errors:
-                        self.db.error('Exception; rolling back transaction')
-                    self.db._con.rollback()
-                self.db._cur.close()
-                self.db._cur = None
+                    lengths.append(np.where(nulls_or_lengths, -1, width))
+            row_sizes = 2 + sum(4 + np.maximum(field_lengths, 0) for field_lengths in lengths)
+            row_starts = np.cumsum(row_sizes) - row_sizes
+            out = np.empty(int(row_sizes.sum()), 'u1')
+            out[row_starts[:, None] + np.arange(2)] = field_count
+            offsets = row_starts + 2
+            for ((width, values, nulls), field_lengths) in zip(columns, lengths):
+                out[offsets[:, None] + np.arange(4)] = field_lengths.astype('>i4').view('u1').reshape(n, 4)
+                data_lengths = np.maximum(field_lengths, 0)
+                if width is None:
+                    data_starts = np.cumsum(data_lengths) - data_lengths
+                    out[np.repeat(offsets + 4 - data_starts, data_lengths) + np.arange(len(values))] = values
+                else:
+                    rows = slice(None) if nulls is None else ~nulls
+                    out[(offsets[rows] + 4)[:, None] + np.arange(width)] = values[rows]
+                offsets = offsets + 4 + data_lengths
+            return out.tobytes()
+
+    # Connection, cursor and transaction nesting.  Shared by all threads for a single
+    # connection; one per thread in pooled mode, where each outermost transaction checks
+    # a connection out of the pool and returns it on commit or rollback.
+    class ConnectionState:
+        def __init__(self, con=None):
+            self.con = con
+            self.cur = None # get cursors using with db.tranaction() as cursor
+            self.transaction_count = 0
 
-    def __init__(self, dbname=None, user=None, password=None, host=None, port=None, **connect_kwargs):
+    class ThreadConnectionState(threading.local, ConnectionState):
+        pass
+
+    # Pass pool_size to share up to pool_size connections between threads.  Each thread gets
+    # its own transactions, so execute, select_* and append_df_to_table can be called from
+    # SimpleThreadPoolExecutor workers.  A thread waits up to pool_timeout seconds (default
+    # forever) for a free connection.
+    def __init__(self, dbname=None, user=None, password=None, host=None, port=None,
+                 pool_size=None, pool_min=1, pool_timeout=None, **connect_kwargs):
         for kwarg in ('dbname', 'user', 'password', 'host', 'port'):
             if locals()[kwarg] != None:
                 connect_kwargs[kwarg] = locals()[kwarg]
-        self._con = psycopg2.connect(**connect_kwargs)
-        self._cur = None # get cursors using with db.tranaction() as cursor
-        self._transaction_count = 0
-    
+        self._connect_kwargs = connect_kwargs
+        if pool_size:
+            self._pool = psycopg2.pool.ThreadedConnectionPool(min(pool_min, pool_size), pool_size, **connect_kwargs)
+            self._pool_size = pool_size
+            self._pool_timeout = pool_timeout
+            # ThreadedConnectionPool raises instead of waiting when all connections are in use
+            self._pool_slots = threading.BoundedSemaphore(pool_size)
+            self._pool_lock = threading.Lock()
+            self._checkout_waits = utils.LatencyHistogram()
+            self._checkout_latencies = utils.LatencyHistogram()
+            self._waited_count = 0
+            # Counted here, since ThreadedConnectionPool keeps its connections to itself
+            self._open_connections = set()
+            self._connect_count = 0
+            self._in_use_count = 0
+            self._state = self.ThreadConnectionState()
+        else:
+            self._pool = None
+            self._state = self.ConnectionState(psycopg2.connect(**connect_kwargs))
+
+    @property
+    def _con(self):
+        return self._state.con
+
+    @property
+    def _cur(self):
+        return self._state.cur
+
+    @property
+    def _transaction_count(self):
+        return self._state.transaction_count
+
+    def _checkout(self):
+        start = time.time()
+        if not self._pool_slots.acquire(timeout=self._pool_timeout):
+            raise psycopg2.pool.PoolError(f'No connection free after {self._pool_timeout} seconds')
+        acquired = time.time()
+        try:
+            con = self._pool.getconn()
+        except:
+            self._pool_slots.release()
+            raise
+        with self._pool_lock:
+            self._checkout_waits.add(acquired - start)
+            self._checkout_latencies.add(time.time() - start)
+            if acquired - start > 0.001:
+                self._waited_count += 1
+            if con not in self._open_connections:
+                self._open_connections.add(con)
+                self._connect_count += 1
+            self._in_use_count += 1
+        return con
+
+    def _checkin(self, con):
+        try:
+            self._pool.putconn(con, close=bool(con.closed))
+        finally:
+            with self._pool_lock:
+                self._in_use_count -= 1
+                # The pool closes connections it doesn't keep
+                if con.closed:
+                    self._open_connections.discard(con)
+            self._pool_slots.release()
+
+    # Pool size, connections open and in use, connections made, and the time spent waiting for a
+    # free connection and checking one out (including connecting), as utils.LatencyHistogram
+    # percentiles in seconds
+    def pool_stats(self):
+        if not self._pool:
+            return None
+        with self._pool_lock:
+            self._open_connections = {con for con in self._open_connections if not con.closed}
+            return {
+                'size': self._pool_size,
+                'open': len(self._open_connections),
+                'in_use': self._in_use_count,
+                'connects': self._connect_count,
+                'checkouts': self._checkout_latencies.count,
+                'waited': self._waited_count,
+                'wait': self._checkout_waits.percentiles(),
+                'checkout': self._checkout_latencies.percentiles()
+            }
+
+    def close(self):
+        if self._pool:
+            self._pool.closeall()
+        else:
+            self._state.con.close()
+
+    _cursor_ids = itertools.count()
+
     def transaction(self, suppress_errors=False):
         return self.Transaction(self, suppress_errors=suppress_errors)
 
@@ -67,15 +344,27 @@ class Psql:
     def error(self, *args, **kwargs):
         print('Psql error:', *args, **kwargs)
 
-    def create_empty_table_from_df(self, table_name, df, override_types={}, primary_key=None, dry_run=False):
-        type_map = {
-            np.dtype('O'): 'text',
-            np.dtype('float64'): 'float8',
-            np.dtype('int64'): 'int8',
-            np.dtype('bool'): 'bool',
-            np.dtype('datetime64[ns]'): 'date'   # date without time or timezone.  use override_types for other choices
-        }
+    # Column types for create_empty_table_from_df and binary append_df_to_table
+    type_map = {
+        np.dtype('O'): 'text',
+        np.dtype('float64'): 'float8',
+        np.dtype('int64'): 'int8',
+        np.dtype('bool'): 'bool',
+        np.dtype('datetime64[ns]'): 'date'   # date without time or timezone.  use override_types for other choices
+    }
 
+    def pg_column_type(self, df, col, override_types={}):
+        if col in override_types:
+            return override_types[col]
+        try:
+            # If geopandas is loaded, look for GeometryDtype
+            if isinstance(df[col].dtype, gpd.array.GeometryDtype):
+                return 'geometry'
+        except:
+            pass
+        return self.type_map[df[col].dtype]
+
+    def create_empty_table_from_df(self, table_name, df, override_types={}, primary_key=None, dry_run=False):
         def col_constraint(col):
             if col == primary_key:
                 return " PRIMARY KEY"
@@ -83,15 +372,7 @@ class Psql:
                 return ""
 
         def col_type(col):
-            if col in override_types:
-                return override_types[col]
-            try:
-                # If geopandas is loaded, look for GeometryDtype
-                if isinstance(df[col].dtype, gpd.array.GeometryDtype):
-                    return 'geometry'
-            except:
-                pass
-            return type_map[df[col].dtype]
+            return self.pg_column_type(df, col, override_types)
 
         sql_cols = [f"    {self.sanitize_column_name(col):63s} {col_type(col)}{col_constraint(col)}" for col in df.columns]
         sql_cols = ',\n'.join(sql_cols)
@@ -103,27 +384,49 @@ class Psql:
         else:
             self.execute(cmd)
 
-    def stopwatch(self, name):
-        return self.Stopwatch(self, name)
+    def stopwatch(self, name, rows=None):
+        return self.Stopwatch(self, name, rows=rows)
 
-    def append_df_to_table(self, df, table_name):
+    # Streams df to COPY, encoding chunk_rows rows at a time while the server ingests.
+    # format='binary' writes PostgreSQL's binary COPY format straight from the NumPy columns,
+    # which is much faster than CSV for numeric and datetime columns and keeps floats exact.
+    # Binary requires the table's column types to match create_empty_table_from_df, so pass
+    # the same override_types.
+    def append_df_to_table(self, df, table_name, chunk_rows=100000, format='csv', override_types={}):
         col_names = [self.sanitize_column_name(c) for c in df.columns]
-        with self.stopwatch(f'Creating csv of {len(df)} records for {table_name}'):
-            csv = io.StringIO(df.to_csv(index=False))
-        with self.stopwatch(f'Appending csv of {len(df)} records to {table_name}'):
+        if format == 'binary':
+            pg_types = [self.pg_column_type(df, col, override_types) for col in df.columns]
+            make_reader = lambda: self.BinaryChunkReader(df, pg_types, chunk_rows=chunk_rows)
+            sql = f"COPY {table_name} ({','.join(col_names)}) FROM stdin BINARY;"
+        elif format == 'csv':
+            make_reader = lambda: self.CsvChunkReader(df, chunk_rows=chunk_rows)
             # postgres ignores CSV header!  so be sure we specify the column names correctly
-            self.copy_expert(sql=f"COPY {table_name} ({','.join(col_names)}) FROM stdin DELIMITER ',' CSV header;",
-                            file=csv)
+            sql = f"COPY {table_name} ({','.join(col_names)}) FROM stdin DELIMITER ',' CSV header;"
+        else:
+            raise Exception(f'Unknown format {format}; use "csv" or "binary"')
+        with self.stopwatch(f'Appending {format} to {table_name}', rows=len(df)):
+            with make_reader() as reader:
+                self.copy_expert(sql=sql, file=reader, size=1 << 20)
+            self.info(f'Encoding {format} took {reader.encode_seconds:1f} seconds')
         self.info(f'Wrote {len(df)} records to {table_name}')
 
     def select_as_df(self, cmd, args=()):
-        return pd.DataFrame(self.select_records(cmd, args, parse_geo=False))
+        return self.records_to_df(*self.select_columns_and_records(cmd, args, parse_geo=False))
     
     def select_as_gdf(self, cmd, args=()):
         return gpd.GeoDataFrame(self.select_records(cmd, args, parse_geo=True))
 
-    # TO DO: convert date types into python dates
+    # DataFrame built from a column of each name, without going through a dict per record
+    def records_to_df(self, col_names, records):
+        columns = zip(*records) if records else [()] * len(col_names)
+        return pd.DataFrame(dict(zip(col_names, columns)))
+
     def select_records(self, cmd, args=(), parse_geo=True):
+        (col_names, records) = self.select_columns_and_records(cmd, args, parse_geo=parse_geo)
+        return [dict(zip(col_names, record)) for record in records]
+
+    # TO DO: convert date types into python dates
+    def select_columns_and_records(self, cmd, args=(), parse_geo=True):
         geometry_type_code = None
         if parse_geo and 'gpd' in vars():
             # If geopandas is loaded as gpd, try to find type_code for postgis geometry type
@@ -150,10 +453,219 @@ class Psql:
                         for record in records:
                             record[i] = shapely.wkb.loads(record[i], hex=True) if not pd.isna(record[i]) else np.nan
 
-        ret = []
-        for record in records:
-            ret.append(dict(zip(col_names, record)))
-        return ret
+        return (col_names, records)
+
+    # Yields (column names, records) for each batch of up to batch_size records, read through a
+    # named server-side cursor so that memory stays proportional to batch_size.  The cursor gets a
+    # connection of its own (from the pool, if pooled), which stays open while iterating, so statements run on this Psql
+    # meanwhile commit or roll back as usual;  stopping early just closes the cursor.
+    # Inside a transaction, the cursor instead reads within that transaction, seeing its changes,
+    # and the transaction decides what is committed.
+    def iter_batches(self, cmd, args=(), batch_size=10000):
+        if self._transaction_count:
+            with self.transaction():
+                yield from self._iter_cursor(self._con, cmd, args, batch_size)
+            return
+        con = self._checkout() if self._pool else psycopg2.connect(**self._connect_kwargs)
+        try:
+            yield from self._iter_cursor(con, cmd, args, batch_size)
+            con.commit()
+        finally:
+            if self._pool:
+                # The pool rolls back a connection returned mid-transaction
+                self._checkin(con)
+            else:
+                con.close()
+
+    def _iter_cursor(self, con, cmd, args, batch_size):
+        cursor = con.cursor(name=f'psql_iter_{next(self._cursor_ids)}')
+        try:
+            cursor.execute(cmd, args)
+            while True:
+                records = cursor.fetchmany(batch_size)
+                if not records:
+                    break
+                yield ([col.name for col in cursor.description], records)
+        finally:
+            cursor.close()
+
+    # Like select_records, but yields records one at a time, reading batch_size at a time
+    def iter_records(self, cmd, args=(), batch_size=10000):
+        for (col_names, records) in self.iter_batches(cmd, args, batch_size=batch_size):
+            for record in records:
+                yield dict(zip(col_names, record))
+
+    # Like select_as_df, but yields DataFrames of up to chunk_rows rows
+    def iter_dfs(self, cmd, args=(), chunk_rows=100000):
+        for (col_names, records) in self.iter_batches(cmd, args, batch_size=chunk_rows):
+            yield self.records_to_df(col_names, records)
+
+    # Fixed-width types copy_out_df reads from binary COPY:  type oid -> (name, binary dtype, NULL
+    # placeholder)
+    binary_out_types = {
+        16: ('bool', '>u1', 'false'),
+        20: ('int8', '>i8', '0'),
+        21: ('int2', '>i2', '0'),
+        23: ('int4', '>i4', '0'),
+        700: ('float4', '>f4', '0'),
+        701: ('float8', '>f8', '0'),
+        1082: ('date', '>i4', '2000-01-01'),
+        1114: ('timestamp', '>i8', '2000-01-01'),
+        1184: ('timestamptz', '>i8', '2000-01-01Z')
+    }
+
+    # Runs query with COPY ... TO STDOUT and parses the output into typed columns, which is much
+    # faster than select_as_df for large results.  Ints, floats, bools, dates and timestamps get
+    # native dtypes from the cursor description:  dates and timestamps become datetime64[ns]
+    # (timestamptz in UTC), or datetime objects if any are outside its range (such as 9999-12-31
+    # or infinity), and ints or bools with NULLs become float64 or object, as in
+    # pd.read_csv.  If every column is one of binary_out_types, the query is copied in binary and
+    # each column converted from a strided view of the output;  otherwise it is copied as CSV and
+    # parsed by pd.read_csv as it streams in.
+    def copy_out_df(self, query, args=None):
+        # query is wrapped in a subquery, where a trailing semicolon is a syntax error
+        query = re.sub(r'[\s;]+$', '', query)
+        with self.transaction() as cursor:
+            if args is not None:
+                query = cursor.mogrify(query, args).decode()
+            cursor.execute(f'SELECT * FROM ({query}) AS q LIMIT 0')
+            col_names = [col.name for col in cursor.description]
+            type_codes = [col.type_code for col in cursor.description]
+            with self.stopwatch(f'Copying out {len(col_names)} columns') as stopwatch:
+                if col_names and all(type_code in self.binary_out_types for type_code in type_codes):
+                    df = self._copy_out_binary(query, type_codes)
+                else:
+                    df = self._copy_out_csv(query, type_codes)
+                df.columns = col_names
+                stopwatch.rows = len(df)
+        return df
+
+    # Copies out each column coalesced to a non-NULL placeholder, plus a bit string of which
+    # columns were NULL, so that every row of the binary output has the same layout
+    def _copy_out_binary(self, query, type_codes):
+        types = [self.binary_out_types[type_code] for type_code in type_codes]
+        n = len(types)
+        aliases = ', '.join(f'c{i}' for i in range(n))
+        values = ', '.join(f"coalesce(c{i}, '{placeholder}'::{pg_type})" for (i, (pg_type, _, placeholder)) in enumerate(types))
+        nulls = ' || '.join(f'(c{i} IS NULL)::int::bit(1)' for i in range(n))
+        sql = f'COPY (SELECT {values}, {nulls} FROM ({query}) AS q({aliases})) TO STDOUT BINARY'
+        out = io.BytesIO()
+        self.copy_expert(sql, out)
+        data = out.getbuffer()
+
+        # 11-byte signature, 32-bit flags, then a 32-bit header extension length and extension
+        header_size = 19 + int.from_bytes(data[15:19], 'big')
+        null_bytes = (n + 7) // 8
+        fields = [('count', '>i2')]
+        for (i, (_, dtype, _)) in enumerate(types):
+            fields += [(f'length{i}', '>i4'), (f'value{i}', dtype)]
+        fields += [('nulls_length', '>i4'), ('nulls_bits', '>i4'), ('nulls', 'u1', (null_bytes,))]
+        row_dtype = np.dtype(fields)
+        body_size = len(data) - header_size - 2  # 16-bit -1 trailer
+        if body_size % row_dtype.itemsize:
+            raise Exception(f'Unexpected binary COPY output size {len(data)} for rows of {row_dtype.itemsize} bytes')
+        rows = np.frombuffer(data, row_dtype, count=body_size // row_dtype.itemsize, offset=header_size)
+        if (rows['count'] != n + 1).any():
+            raise Exception('Unexpected field count in binary COPY output')
+        is_null = np.unpackbits(rows['nulls'], axis=1, count=n).astype(bool)
+
+        columns = {}
+        for (i, (pg_type, _, _)) in enumerate(types):
+            values = rows[f'value{i}']
+            nulls = is_null[:, i]
+            if pg_type in ('date', 'timestamp', 'timestamptz'):
+                units = values.astype('int64')
+                unit_ns = 86400000000000 if pg_type == 'date' else 1000
+                # datetime64[ns] covers 1677-2262;  outside that (e.g. 9999-12-31 or infinity),
+                # scaling would silently overflow, so the column is datetime objects instead
+                (epoch, int64) = (int(self.BinaryChunkReader.pg_epoch), np.iinfo('int64'))
+                (low, high) = (-((epoch - (int64.min + 1)) // unit_ns), (int64.max - epoch) // unit_ns)
+                if ((units[~nulls] < low) | (units[~nulls] > high)).any():
+                    column = np.array([None if null else self.datetime_from_pg(pg_type, unit)
+                                       for (unit, null) in zip(units.tolist(), nulls)], object)
+                else:
+                    column = (units * unit_ns + self.BinaryChunkReader.pg_epoch).view('datetime64[ns]')
+                    column[nulls] = np.datetime64('NaT')
+                    if pg_type == 'timestamptz':
+                        column = pd.DatetimeIndex(column).tz_localize('UTC')
+            elif pg_type == 'bool':
+                column = values.astype(bool)
+                if nulls.any():
+                    column = column.astype(object)
+                    column[nulls] = None
+            else:
+                column = values.astype(values.dtype.newbyteorder('='))
+                if nulls.any():
+                    column = column.astype('float64')
+                    column[nulls] = np.nan
+            columns[i] = column
+        return pd.DataFrame(columns)
+
+    # datetime.date or datetime.datetime (UTC for timestamptz) from a value of a pg date, timestamp
+    # or timestamptz:  binary COPY's days or microseconds since 2000-01-01, or CSV text.  Infinity
+    # becomes the max or min value, as psycopg2 returns it.
+    def datetime_from_pg(self, pg_type, value):
+        if pg_type == 'date':
+            (max_value, min_value, epoch) = (datetime.date.max, datetime.date.min, datetime.date(2000, 1, 1))
+        else:
+            (max_value, min_value, epoch) = (datetime.datetime.max, datetime.datetime.min, datetime.datetime(2000, 1, 1))
+            if pg_type == 'timestamptz':
+                (max_value, min_value, epoch) = (t.replace(tzinfo=datetime.timezone.utc) for t in (max_value, min_value, epoch))
+        if isinstance(value, str):
+            if value in ('infinity', '-infinity'):
+                return max_value if value == 'infinity' else min_value
+            if pg_type == 'date':
+                return datetime.date.fromisoformat(value)
+            parsed = datetime.datetime.fromisoformat(value)
+            return parsed.astimezone(datetime.timezone.utc) if pg_type == 'timestamptz' else parsed
+        try:
+            return epoch + (datetime.timedelta(days=value) if pg_type == 'date' else datetime.timedelta(microseconds=value))
+        except OverflowError:
+            # Only infinity is beyond year 1-9999
+            return max_value if value > 0 else min_value
+
+    # Streams CSV from COPY through a pipe to pd.read_csv in another thread
+    def _copy_out_csv(self, query, type_codes):
+        types = [self.binary_out_types.get(type_code, (None,))[0] for type_code in type_codes]
+        # Leave ints to read_csv, to become int64 or float64 if there are NULLs
+        dtypes = {i: {'float4': 'float32', 'float8': 'float64'}.get(pg_type, object)
+                  for (i, pg_type) in enumerate(types) if pg_type not in ('int2', 'int4', 'int8')}
+        sql = f"COPY ({query}) TO STDOUT WITH CSV NULL '\\N'"
+        encoding = psycopg2.extensions.encodings.get(self._con.encoding, 'utf-8')
+        (read_fd, write_fd) = os.pipe()
+        csv = open(read_fd, 'rb')
+        def read():
+            try:
+                return pd.read_csv(csv, header=None, names=range(len(types)), dtype=dtypes,
+                                   na_values=['\\N'], keep_default_na=False, encoding=encoding)
+            finally:
+                # If read_csv failed, COPY gets EPIPE instead of blocking on a full pipe
+                csv.close()
+        reader = utils.ThCall(read)
+        try:
+            with open(write_fd, 'wb', buffering=0) as out:
+                self.copy_expert(sql, out)
+        except BrokenPipeError:
+            # The reader failed;  raise its exception below
+            pass
+        finally:
+            # read_csv ends at the end of the pipe, after any error too
+            if reader.is_alive():
+                reader.join()
+        df = reader.value()
+
+        for (i, pg_type) in enumerate(types):
+            if pg_type == 'bool':
+                df[i] = df[i].map({'t': True, 'f': False})
+            elif pg_type in ('date', 'timestamp', 'timestamptz'):
+                try:
+                    df[i] = pd.to_datetime(df[i], format='ISO8601', utc=(pg_type == 'timestamptz'))
+                except (ValueError, OverflowError):
+                    # Outside datetime64[ns] (e.g. 9999-12-31), or infinity
+                    df[i] = [None if pd.isna(text) else self.datetime_from_pg(pg_type, text) for text in df[i]]
+            elif pg_type in ('int2', 'int4') and df[i].dtype == 'int64':
+                df[i] = df[i].astype(self.binary_out_types[type_codes[i]][1][1:])
+        return df
 
     def select_record(self, cmd, args=()):
         records = self.select_records(cmd, args)
@@ -1,5 +1,6 @@
 #%%
-import json, os, psycopg2, threading, unittest
+import contextlib, datetime, io, json, os, psycopg2, threading, time, unittest, unittest.mock
+import numpy as np
 import pandas as pd
 
 if 'reload_module' in vars():
@@ -9,6 +10,10 @@ from utils import *
 reload_module('psql')
 from psql import Psql
 
+# Speed comparisons depend on the machine and what else it's running, so they only run when
+# RUN_BENCHMARKS is set
+benchmark = unittest.skipUnless(os.environ.get('RUN_BENCHMARKS'), 'set RUN_BENCHMARKS=1 to run benchmarks')
+
 class TestPsql(unittest.TestCase):
     def setUp(self):
         db_config = os.path.join(os.path.dirname(__file__), '.test_psql_credentials.json')
@@ -68,6 +73,212 @@ class TestPsql(unittest.TestCase):
 
         self.assertEquals(None, self.db.select_record_or_none('SELECT * FROM test_df WHERE i=999'))
 
+    def test_append_chunks(self):
+        df = pd.DataFrame(dict(i=range(5), txt=['a', 'b,c', 'd"e', None, 'f\ng']))
+        self.db.execute('DROP TABLE IF EXISTS test_chunks')
+        self.db.create_empty_table_from_df('test_chunks', df)
+        self.db.append_df_to_table(df, 'test_chunks', chunk_rows=2)
+        self.db.append_df_to_table(df.iloc[:0], 'test_chunks', chunk_rows=2)
+        df2 = self.db.select_as_df('SELECT * FROM test_chunks ORDER BY i')
+        self.assertTrue(df.equals(df2))
+
+        # Appends to one table aggregate under one profile path, whatever their size
+        profile = StopwatchProfile()
+        with unittest.mock.patch.object(Stopwatch, 'profile', profile), contextlib.redirect_stdout(io.StringIO()) as out:
+            self.db.append_df_to_table(df, 'test_chunks')
+            self.db.append_df_to_table(df.iloc[:2], 'test_chunks')
+        self.assertEqual([(('Appending csv to test_chunks',), 2)],
+                         [(path, s['count']) for (path, s) in profile.stats().items() if 'test_chunks' in path[0]])
+        self.assertIn('(5 rows, ', out.getvalue())
+
+        # A failed COPY stops the producer thread
+        with self.db.CsvChunkReader(df, chunk_rows=1, queue_chunks=1) as csv:
+            csv.read(1)
+        self.assertFalse(csv._thread.is_alive())
+        with self.assertRaises(psycopg2.errors.UndefinedTable):
+            self.db.append_df_to_table(df, 'no_such_table', chunk_rows=1)
+        self.db.execute('DROP TABLE test_chunks')
+
+    def test_append_binary(self):
+        df = pd.DataFrame(dict(
+            i=[1, -3, 5], f=[1.5, float('nan'), 1 / 3], txt=['héllo', None, 'a\tb'], b=[True, False, True],
+            d=pd.to_datetime(['2020-01-02', None, '1969-07-20']),
+            t=pd.to_datetime(['2020-01-02 03:04:05.123456', '1999-12-31 00:00:00.000000', None])))
+        override_types = {'t': 'timestamp'}
+        self.db.execute('DROP TABLE IF EXISTS test_binary')
+        self.db.create_empty_table_from_df('test_binary', df, override_types=override_types)
+        self.db.append_df_to_table(df, 'test_binary', format='binary', override_types=override_types, chunk_rows=2)
+        self.db.append_df_to_table(df.iloc[:0], 'test_binary', format='binary', override_types=override_types)
+        df2 = self.db.select_as_df('SELECT * FROM test_binary')
+        self.assertEqual([1, -3, 5], list(df2.i))
+        self.assertEqual(1 / 3, df2.f[2])  # exact, unlike through CSV text
+        self.assertTrue(pd.isna(df2.f[1]))
+        self.assertEqual(['héllo', None, 'a\tb'], list(df2.txt))
+        self.assertEqual([True, False, True], list(df2.b))
+        self.assertEqual([datetime.date(2020, 1, 2), None, datetime.date(1969, 7, 20)], list(df2.d))
+        self.assertEqual(pd.Timestamp('2020-01-02 03:04:05.123456'), df2.t[0])
+        self.assertTrue(pd.isna(df2.t[2]))
+
+        # All fixed width and no nulls
+        df = df[['i', 'f', 'b']].fillna(0)
+        self.db.execute('DROP TABLE test_binary')
+        self.db.create_empty_table_from_df('test_binary', df)
+        self.db.append_df_to_table(df, 'test_binary', format='binary')
+        self.assertTrue(df.equals(self.db.select_as_df('SELECT * FROM test_binary')))
+        self.db.execute('DROP TABLE test_binary')
+
+    # Appends rows x 20 float64 as CSV and as binary, checks both round-trip, and returns seconds per format
+    def append_formats(self, rows):
+        df = pd.DataFrame({f'c{i}': np.random.rand(rows) for i in range(20)})
+        timings = {}
+        for format in ['csv', 'binary']:
+            self.db.execute('DROP TABLE IF EXISTS test_benchmark')
+            self.db.create_empty_table_from_df('test_benchmark', df)
+            start = time.time()
+            self.db.append_df_to_table(df, 'test_benchmark', format=format)
+            timings[format] = time.time() - start
+            df2 = self.db.select_as_df('SELECT * FROM test_benchmark')
+            self.assertTrue(np.allclose(df.values, df2.values, rtol=1e-15, atol=0))
+        self.assertTrue(df.equals(df2))  # binary is exact
+        self.db.execute('DROP TABLE test_benchmark')
+        return timings
+
+    def test_append_formats(self):
+        self.append_formats(10000)
+
+    # Benchmark:  appending 200000 x 20 float64 as CSV vs. binary
+    @benchmark
+    def test_binary_benchmark(self):
+        timings = self.append_formats(200000)
+        print('200000 x 20 float64 append: csv %.2f seconds, binary %.2f seconds' % (timings['csv'], timings['binary']))
+        self.assertLess(timings['binary'] * 3, timings['csv'])
+
+    def test_iter(self):
+        self.db.execute('DROP TABLE IF EXISTS test_iter')
+        self.db.execute('CREATE TABLE test_iter (i int8, txt text)')
+        self.db.execute("INSERT INTO test_iter SELECT i, 'row ' || i FROM generate_series(0, 24) AS i")
+        query = 'SELECT * FROM test_iter WHERE i >= %s ORDER BY i'
+
+        records = list(self.db.iter_records(query, (0,), batch_size=10))
+        self.assertEqual([dict(i=i, txt=f'row {i}') for i in range(25)], records)
+        dfs = list(self.db.iter_dfs(query, (5,), chunk_rows=10))
+        self.assertEqual([10, 10], [len(df) for df in dfs])
+        self.assertEqual(['i', 'txt'], list(dfs[0].columns))
+        self.assertTrue(pd.concat(dfs, ignore_index=True).equals(self.db.select_as_df(query, (5,))))
+        self.assertEqual([], list(self.db.iter_dfs(query, (100,))))
+        self.assertEqual(['i', 'txt'], list(self.db.select_as_df(query, (100,)).columns))
+
+        # The cursor has its own connection, so statements run while iterating commit as usual,
+        # however iteration ends
+        records = self.db.iter_records(query, (0,), batch_size=10)
+        next(records)
+        self.db.execute('INSERT INTO test_iter VALUES (%s, %s)', (100, 'added'))
+        del records
+        self.assertEqual(26, self.db.select_record('SELECT count(*) FROM test_iter')['count'])
+        for record in self.db.iter_records(query, (0,), batch_size=10):
+            self.db.execute('INSERT INTO test_iter VALUES (%s, %s)', (101, 'added'))
+            break
+        self.assertEqual(0, self.db._transaction_count)
+        self.assertEqual(27, self.db.select_record('SELECT count(*) FROM test_iter')['count'])
+
+        # Inside a transaction, the cursor sees its changes, and an exception in the loop body rolls it back
+        with self.assertRaises(ZeroDivisionError), contextlib.redirect_stdout(io.StringIO()):
+            with self.db.transaction():
+                self.db.execute('INSERT INTO test_iter VALUES (%s, %s)', (102, 'added'))
+                self.assertEqual(3, len(list(self.db.iter_records(query, (100,)))))
+                for record in self.db.iter_records(query, (0,), batch_size=10):
+                    self.db.execute('INSERT INTO test_iter VALUES (%s, %s)', (103, 'added'))
+                    1 / 0
+        self.assertEqual(0, self.db._transaction_count)
+        self.assertEqual(27, self.db.select_record('SELECT count(*) FROM test_iter')['count'])
+        self.db.execute('DROP TABLE test_iter')
+
+    def test_copy_out_df(self):
+        query = """SELECT i::int8 AS i, i::int2 AS small, i / 4.0::float8 AS f, mod(i, 2) = 0 AS b,
+                          DATE '2020-01-01' + i AS d, TIMESTAMP '2020-01-01 00:00:00.5' + i * INTERVAL '1 hour' AS t,
+                          TIMESTAMPTZ '2020-01-01Z' + i * INTERVAL '1 minute' AS tz,
+                          NULLIF(i, 1) AS n, NULLIF(mod(i, 2) = 0, i = 1) AS nb, NULLIF(DATE '2020-01-01', DATE '2020-01-01' + i) AS nd
+                   FROM generate_series(0, %s) AS i"""
+        df = self.db.copy_out_df(query, (3,))
+        self.assertEqual(['int64', 'int16', 'float64', 'bool', 'datetime64[ns]', 'datetime64[ns]', 'datetime64[ns, UTC]', 'float64', 'object', 'datetime64[ns]'],
+                         [str(dtype) for dtype in df.dtypes])
+        self.assertEqual([0, 1, 2, 3], list(df.i))
+        self.assertEqual([0, 0.25, 0.5, 0.75], list(df.f))
+        self.assertEqual([True, False, True, False], list(df.b))
+        self.assertEqual(pd.Timestamp('2020-01-03'), df.d[2])
+        self.assertEqual(pd.Timestamp('2020-01-01 02:00:00.5'), df.t[2])
+        self.assertEqual(pd.Timestamp('2020-01-01 00:02:00Z'), df.tz[2])
+        self.assertEqual([0, 2, 3], list(df.n.dropna()))
+        self.assertEqual([True, False, True, None], list(df.nb))
+        self.assertTrue(pd.isna(df.nd[0]))
+        self.assertTrue(df.n.equals(self.db.select_as_df(query, (3,)).n))
+
+        # The same columns with text come through CSV
+        text_query = query.replace(' FROM', """, NULLIF(i::text, '2') AS txt, '' AS blank, 'a,"b"\nc' AS quoted FROM""")
+        df2 = self.db.copy_out_df(text_query, (3,))
+        self.assertTrue(df.equals(df2[df.columns]))
+        self.assertEqual(['0', '1', None, '3'], [None if pd.isna(txt) else txt for txt in df2.txt])
+        self.assertEqual(['', 'a,"b"\nc'], [df2.blank[0], df2.quoted[0]])
+
+        for q in [query, text_query]:
+            empty = self.db.copy_out_df(q, (-1,))
+            self.assertEqual((0, len(df2.columns) if q is text_query else len(df.columns)), empty.shape)
+        # Beyond datetime64[ns], including infinity, dates and timestamps are objects as from select_as_df
+        sentinels = """SELECT d::date AS d, d::timestamp AS t, d::timestamptz AS tz
+                       FROM (VALUES ('9999-12-31'), ('infinity'), ('-infinity'), (NULL), ('2020-01-02')) AS v(d);"""
+        expected = self.db.select_as_df(sentinels)
+        self.assertEqual(datetime.date(9999, 12, 31), expected.d[0])
+        for q in [sentinels, sentinels.replace(' FROM', ", 'text' AS txt FROM")]:
+            df3 = self.db.copy_out_df(q)
+            for col in ['d', 't', 'tz']:
+                self.assertEqual(expected[col].tolist(), df3[col].tolist())
+
+        with self.assertRaises(psycopg2.errors.DivisionByZero):
+            self.db.copy_out_df("SELECT 1 / (i - 2) AS x, 'text' AS y FROM generate_series(0, 100000) AS i")
+        self.assertEqual(0, self.db._transaction_count)
+
+    def test_copy_out_csv_errors(self):
+        query = "SELECT i, 'café ' || i AS txt FROM generate_series(0, 200000) AS i"
+        # CSV is decoded in the connection's encoding
+        self.db.execute("SET client_encoding TO 'LATIN1'")
+        self.assertEqual('café 5', self.db.copy_out_df(query).txt[5])
+        # If read_csv fails partway, COPY doesn't block on the full pipe, and read_csv's error is raised
+        def fail(csv, **kwargs):
+            csv.read(10)
+            raise ValueError('read_csv failed')
+        with unittest.mock.patch('pandas.read_csv', fail), contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaisesRegex(ValueError, 'read_csv failed'):
+                self.db.copy_out_df(query)
+        self.assertEqual(0, self.db._transaction_count)
+        self.assertEqual(200001, len(self.db.copy_out_df(query)))
+
+    # Reads rows of mixed types with select_as_df and copy_out_df, checks they match, and returns seconds for each
+    def select_formats(self, rows):
+        self.db.execute('DROP TABLE IF EXISTS test_benchmark')
+        self.db.execute(f"""CREATE TABLE test_benchmark AS
+                            SELECT i::int8 AS i, random() AS f, TIMESTAMP '2020-01-01' + i * INTERVAL '1 second' AS t, mod(i, 3) = 0 AS b
+                            FROM generate_series(1, {rows}) AS i""")
+        timings = {}
+        dfs = {}
+        for (label, select) in [('select_as_df', self.db.select_as_df), ('copy_out_df', self.db.copy_out_df)]:
+            start = time.time()
+            dfs[label] = select('SELECT * FROM test_benchmark ORDER BY i')
+            timings[label] = time.time() - start
+        self.assertEqual(rows, len(dfs['copy_out_df']))
+        self.assertTrue(dfs['select_as_df'].equals(dfs['copy_out_df']))
+        self.db.execute('DROP TABLE test_benchmark')
+        return timings
+
+    def test_select_formats(self):
+        self.select_formats(10000)
+
+    # Benchmark:  reading 1000000 rows with select_as_df vs. copy_out_df
+    @benchmark
+    def test_copy_out_benchmark(self):
+        timings = self.select_formats(1000000)
+        print('1000000 rows: select_as_df %.2f seconds, copy_out_df %.2f seconds' % (timings['select_as_df'], timings['copy_out_df']))
+        self.assertLess(timings['copy_out_df'] * 3, timings['select_as_df'])
+
     def test_insert(self):
         self.db.execute('DROP TABLE IF EXISTS foo')
         self.db.execute('CREATE TABLE foo (i int8, txt text)')
@@ -109,6 +320,51 @@ class TestPsql(unittest.TestCase):
         self.assertEquals(30, read_x())
 
 
+    def test_pool(self):
+        db_config = os.path.join(os.path.dirname(__file__), '.test_psql_credentials.json')
+        args = json.load(open(db_config)) if os.path.exists(db_config) else {'dbname': 'postgres'}
+        db = Psql(**args, pool_size=4)
+        db.execute('DROP TABLE IF EXISTS pooled')
+        db.execute('CREATE TABLE pooled (i int, thread text)')
+
+        def insert(i):
+            try:
+                with db.transaction():
+                    db.insert_record('pooled', dict(i=i, thread=threading.current_thread().name))
+                    time.sleep(0.05)
+                    self.assertEqual(1, db._transaction_count)
+                    if i % 5 == 0:
+                        raise ValueError('roll back')
+            except ValueError:
+                pass
+            return db.select_record('SELECT count(*) FROM pooled WHERE i = %s', (i,))['count']
+
+        pool = SimpleThreadPoolExecutor(8)
+        for i in range(20):
+            pool.submit(insert, i)
+        self.assertEqual([0 if i % 5 == 0 else 1 for i in range(20)], pool.shutdown())
+
+        self.assertEqual(16, db.select_record('SELECT count(*) FROM pooled')['count'])
+        stats = db.pool_stats()
+        self.assertEqual(4, stats['size'])
+        self.assertEqual(0, stats['in_use'])
+        self.assertLessEqual(stats['open'], 4)
+        self.assertGreater(stats['waited'], 0)
+        # Connections are reused rather than made for each checkout
+        self.assertLess(stats['connects'], stats['checkouts'])
+        self.assertGreater(stats['wait']['max'], 0)
+        self.assertLessEqual(stats['checkout']['p50'], stats['checkout']['max'])
+        self.assertEqual(0, db._transaction_count)
+        # iter_records checks its cursor's connection out of the pool, and returns it when done
+        records = db.iter_records('SELECT i FROM pooled ORDER BY i')
+        self.assertEqual(1, next(records)['i'])
+        self.assertEqual(1, db.pool_stats()['in_use'])
+        del records
+        self.assertEqual(0, db.pool_stats()['in_use'])
+        db.execute('DROP TABLE pooled')
+        db.close()
+
+
         # ThCall(func, *args, **kwargs) calls func(*args, **kwargs) in a separate thread
 # value() waits for func to complete and returns its value
 
@@ -0,0 +1,1170 @@
+#%%
+import asyncio, collections, contextlib, gzip, http.server, io, json, marshal, os, shutil, subprocess, sys, tempfile, threading, time, traceback, tracemalloc, unittest, unittest.mock, zipfile
+
+if 'reload_module' in vars():
+    reload_module('utils')
+from utils import *
+
+# Speed comparisons depend on the machine and what else it's running, so they only run when
+# RUN_BENCHMARKS is set
+benchmark = unittest.skipUnless(os.environ.get('RUN_BENCHMARKS'), 'set RUN_BENCHMARKS=1 to run benchmarks')
+
+# Local stand-in for a download server.  Serves payload, honoring Range requests if ranges is True.
+# If truncate_first > 0, the first truncate_first responses send the full Content-Length
+# but close the connection halfway through the body.
+class LocalServer(http.server.ThreadingHTTPServer):
+    def __init__(self, payload=b'', truncate_first=0, ranges=True):
+        super().__init__(('127.0.0.1', 0), LocalHandler)
+        self.payload = payload
+        self.truncate_first = truncate_first
+        self.ranges = ranges
+        self.etag = None
+        self.last_modified = None
+        self.lock = threading.Lock()
+        self.requests = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, path='/file'):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+        self.server_close()
+
+class LocalHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(dict(self.headers, method='HEAD'))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(server.payload)))
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_validators()
+        self.end_headers()
+
+    def send_validators(self):
+        if self.server.etag:
+            self.send_header('ETag', self.server.etag)
+        if self.server.last_modified:
+            self.send_header('Last-Modified', self.server.last_modified)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(dict(self.headers, path=self.path))
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        with server.lock:
+            truncate = server.truncate_first > 0
+            server.truncate_first -= 1
+        if ((server.etag and self.headers.get('If-None-Match') == server.etag) or
+                (server.last_modified and self.headers.get('If-Modified-Since') == server.last_modified)):
+            self.send_response(304)
+            self.end_headers()
+            return
+        payload = memoryview(server.payload)
+        start, end = 0, len(payload) - 1
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range not in (server.etag, server.last_modified):
+            range_header = None  # changed since;  send the whole file
+        if range_header and server.ranges:
+            (start, range_end) = re.match(r'bytes=(\d+)-(\d*)', range_header).groups()
+            start = int(start)
+            end = min(end, int(range_end)) if range_end else end
+            if start >= len(payload):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(payload))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(payload)))
+        else:
+            self.send_response(200)
+        body = payload[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_validators()
+        self.end_headers()
+        if truncate:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, True)
+
+    def test_download_file(self):
+        payload = os.urandom(300000)
+        filename = os.path.join(self.dir, 'sub/file.bin')
+        with LocalServer(payload) as server:
+            self.assertTrue(download_file(server.url(), filename, chunk_size=4096))
+            self.assertEqual(payload, open(filename, 'rb').read())
+            self.assertFalse(os.path.exists(filename + '.tmp'))
+            # Second call is a no-op
+            self.assertTrue(download_file(server.url(), filename))
+            self.assertEqual(1, len(server.requests))
+
+    def test_download_file_resumes(self):
+        payload = os.urandom(300000)
+        filename = os.path.join(self.dir, 'file.bin')
+        with LocalServer(payload, truncate_first=2) as server:
+            self.assertTrue(download_file(server.url(), filename, chunk_size=4096, retry_delay=0))
+            self.assertEqual(payload, open(filename, 'rb').read())
+            self.assertEqual(3, len(server.requests))
+            self.assertNotIn('Range', server.requests[0])
+            # Each retry picks up roughly where the previous connection was dropped
+            offsets = [int(re.match(r'bytes=(\d+)-', r['Range']).group(1)) for r in server.requests[1:]]
+            self.assertGreater(offsets[0], 100000)
+            self.assertGreater(offsets[1], offsets[0])
+
+    def test_download_file_stale_tmp(self):
+        payload = b'NEW-VERSION-of the whole file'
+        filename = os.path.join(self.dir, 'file.bin')
+        with LocalServer(payload) as server:
+            # A .tmp without a validator, e.g. from an older version, is not resumed
+            open(filename + '.tmp', 'wb').write(b'OLD-VERSION-')
+            self.assertTrue(download_file(server.url(), filename))
+            self.assertEqual(payload, open(filename, 'rb').read())
+            self.assertNotIn('Range', server.requests[-1])
+            self.assertEqual([], [name for name in os.listdir(self.dir) if '.tmp' in name])
+
+            # Resumed with If-Range when its validator still matches, else downloaded again
+            server.etag = '"v2"'
+            for (etag, resumed) in [('"v2"', True), ('"v1"', False)]:
+                os.unlink(filename)
+                open(filename + '.tmp', 'wb').write(payload[:12] if resumed else b'OLD-VERSION-')
+                open(filename + '.tmp.validator', 'w').write(json.dumps({'url': server.url(), 'etag': etag}))
+                with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                    self.assertTrue(download_file(server.url(), filename))
+                self.assertEqual(payload, open(filename, 'rb').read())
+                self.assertEqual(etag, server.requests[-1]['If-Range'])
+                self.assertEqual(resumed, 'Resuming' in stdout.getvalue())
+                self.assertFalse(os.path.exists(filename + '.tmp.validator'))
+
+    def test_download_file_gives_up(self):
+        filename = os.path.join(self.dir, 'file.bin')
+        with LocalServer(os.urandom(1000), truncate_first=10) as server:
+            self.assertFalse(download_file(server.url(), filename, retries=2, retry_delay=0))
+            self.assertEqual(3, len(server.requests))
+            self.assertFalse(os.path.exists(filename))
+
+    def test_download_file_flat_memory(self):
+        payload = os.urandom(32 * 1024 * 1024)
+        filename = os.path.join(self.dir, 'file.bin')
+        with LocalServer(payload) as server:
+            tracemalloc.start()
+            try:
+                self.assertTrue(download_file(server.url(), filename))
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        self.assertEqual(len(payload), os.path.getsize(filename))
+        self.assertLess(peak, len(payload) / 4)
+
+    def test_download_file_parallel(self):
+        payload = os.urandom(5 * 1024 * 1024 + 17)
+        filename = os.path.join(self.dir, 'file.bin')
+        with LocalServer(payload, truncate_first=1) as server:
+            self.assertTrue(download_file(server.url(), filename, connections=4, retry_delay=0))
+            self.assertEqual(payload, open(filename, 'rb').read())
+            gets = [r for r in server.requests if 'method' not in r]
+            # 4 ranges, plus one retry of the range that was truncated
+            self.assertEqual(5, len(gets))
+            self.assertTrue(all('Range' in r for r in gets))
+
+    def test_download_file_parallel_without_ranges(self):
+        payload = os.urandom(5 * 1024 * 1024)
+        filename = os.path.join(self.dir, 'file.bin')
+        with LocalServer(payload, ranges=False) as server:
+            self.assertTrue(download_file_parallel(server.url(), filename, connections=4))
+            self.assertEqual(payload, open(filename, 'rb').read())
+            self.assertEqual(['HEAD', None], [r.get('method') for r in server.requests])
+
+    def test_download_files(self):
+        payload = os.urandom(100000)
+        with LocalServer(payload) as server:
+            pairs = [(server.url('/file%d' % i), os.path.join(self.dir, 'file%d' % i)) for i in range(6)]
+            pairs.append((server.url('/missing'), os.path.join(self.dir, 'missing')))
+            open(pairs[0][1], 'wb').write(b'already here')
+            report = download_files(pairs, max_workers=4, per_host_limit=2, retry_delay=0)
+        self.assertEqual(['skipped'] + ['downloaded'] * 5 + ['failed'], [f['status'] for f in report['files']])
+        self.assertEqual([pairs[-1][0]], [f['url'] for f in report['failures']])
+        self.assertEqual(5 * len(payload), report['bytes'])
+        [host] = report['hosts'].values()
+        self.assertEqual((5, 5 * len(payload)), (host['files'], host['bytes']))
+        downloaded = [f['seconds'] for f in report['files'] if f['status'] == 'downloaded']
+        self.assertGreaterEqual(host['seconds'], max(downloaded))
+        self.assertLessEqual(host['seconds'], min(sum(downloaded), report['seconds']) + 1e-3)
+        for url, filename in pairs[1:-1]:
+            self.assertEqual(payload, open(filename, 'rb').read())
+        self.assertEqual(6, len(server.requests))
+
+    def test_download_file_revalidate(self):
+        filename = os.path.join(self.dir, 'file.bin')
+        with LocalServer(b'version 1') as server:
+            server.etag = '"v1"'
+            self.assertTrue(download_file(server.url(), filename, revalidate=True))
+            self.assertTrue(os.path.exists(os.path.join(self.dir, '.download_cache.sqlite')))
+            entry = download_cache(os.path.join(self.dir, '.download_cache.sqlite')).lookup(server.url(), filename)
+            self.assertEqual(('"v1"', 9), (entry['etag'], entry['size']))
+
+            # Unchanged:  conditional GET returns 304, file is left alone
+            self.assertTrue(download_file(server.url(), filename, revalidate=True))
+            self.assertEqual('"v1"', server.requests[-1]['If-None-Match'])
+            self.assertEqual(b'version 1', open(filename, 'rb').read())
+
+            # Changed on server:  refetched
+            server.payload, server.etag = b'version 2', '"v2"'
+            self.assertTrue(download_file(server.url(), filename, revalidate=True))
+            self.assertEqual(b'version 2', open(filename, 'rb').read())
+
+            # Without revalidate, existing file is trusted as before
+            server.payload, server.etag = b'version 3', '"v3"'
+            count = len(server.requests)
+            self.assertTrue(download_file(server.url(), filename))
+            self.assertEqual(count, len(server.requests))
+
+    def test_download_file_revalidate_adopts_existing(self):
+        filename = os.path.join(self.dir, 'file.bin')
+        open(filename, 'wb').write(b'version 1')
+        with LocalServer(b'version 1') as server:
+            server.last_modified = 'Sat, 01 Jan 2000 00:00:00 GMT'
+            self.assertTrue(download_file(server.url(), filename, revalidate=True))
+            self.assertEqual(['HEAD'], [r.get('method') for r in server.requests])
+            self.assertTrue(download_file(server.url(), filename, revalidate=True))
+            self.assertEqual(server.last_modified, server.requests[-1]['If-Modified-Since'])
+
+class TestUnzip(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, True)
+
+    def tree(self, dir):
+        return {os.path.relpath(os.path.join(root, f), dir): open(os.path.join(root, f), 'rb').read()
+                for root, dirs, files in os.walk(dir) for f in files}
+
+    def test_unzip_file(self):
+        # Compressible but not trivially so
+        contents = {'a.shp': os.urandom(1000) * 3000, 'a.dbf': os.urandom(500) * 2000,
+                    "sub dir/it's.prj": b'GEOGCS', 'sub dir/empty': b''}
+        for name in ["in-process's.zip", 'subprocess.zip']:
+            with zipfile.ZipFile(os.path.join(self.dir, name), 'w', zipfile.ZIP_DEFLATED) as z:
+                for member, data in contents.items():
+                    z.writestr(member, data)
+
+        start = time.time()
+        exdir = unzip_file(os.path.join(self.dir, "in-process's.zip"), max_workers=4)
+        in_process = time.time() - start
+        start = time.time()
+        subprocess_exdir = unzip_file(os.path.join(self.dir, 'subprocess.zip'), use_subprocess=True)
+        print('unzip_file in-process %.3f seconds, subprocess %.3f seconds' % (in_process, time.time() - start))
+
+        self.assertEqual(os.path.join(self.dir, "in-process's"), exdir)
+        self.assertFalse(os.path.exists(exdir + '.tmp'))
+        self.assertEqual(contents, self.tree(exdir))
+        self.assertEqual(self.tree(subprocess_exdir), self.tree(exdir))
+
+    def test_gunzip_file(self):
+        data = os.urandom(1000) * 5000
+        for name in ["it's.gz", 'subprocess.gz']:
+            with gzip.open(os.path.join(self.dir, name), 'wb') as f:
+                f.write(data)
+        self.assertEqual(os.path.join(self.dir, "it's"), gunzip_file(os.path.join(self.dir, "it's.gz")))
+        gunzip_file(os.path.join(self.dir, 'subprocess.gz'), use_subprocess=True)
+        self.assertEqual(data, open(os.path.join(self.dir, "it's"), 'rb').read())
+        self.assertEqual(data, open(os.path.join(self.dir, 'subprocess'), 'rb').read())
+
+class TestSubprocess(unittest.TestCase):
+    def test_subprocess_check(self):
+        self.assertEqual('err\nout\n', subprocess_check('echo out; echo err >&2'))
+        self.assertEqual('out\n', subprocess_check(['echo', 'out']))
+        self.assertEqual('', subprocess_check('exit 3', ignore_error=True))
+        with self.assertRaises(Exception):
+            subprocess_check('exit 3')
+
+    def test_subprocess_lines_are_incremental(self):
+        start = time.time()
+        arrivals = []
+        for (stream, line) in subprocess_lines('echo one; sleep 1; echo two >&2'):
+            arrivals.append((stream, line, time.time() - start))
+        self.assertEqual([('stdout', 'one\n'), ('stderr', 'two\n')], [a[:2] for a in arrivals])
+        self.assertLess(arrivals[0][2], 0.9)
+        self.assertGreater(arrivals[1][2], 0.9)
+
+    def test_subprocess_check_stream(self):
+        lines = []
+        out = subprocess_check('for i in $(seq 1 5000); do echo line $i; done', on_line=lines.append, tail_lines=10)
+        self.assertEqual(5000, len(lines))
+        self.assertEqual(''.join(lines[-10:]), out)
+        with self.assertRaises(Exception) as cm:
+            subprocess_check('for i in $(seq 1 5000); do echo line $i; done; echo failed >&2; exit 1',
+                             stream=True, tail_lines=10)
+        message = str(cm.exception)
+        self.assertIn('line 5000\n', message)
+        self.assertIn('failed\n', message)
+        self.assertNotIn('line 4990\n', message)
+
+    def test_subprocess_lines_kills_when_abandoned(self):
+        lines = subprocess_lines(['sh', '-c', 'echo first; exec sleep 30'])
+        self.assertEqual(('stdout', 'first\n'), next(lines))
+        start = time.time()
+        lines.close()
+        self.assertLess(time.time() - start, 5)
+
+class TestAsyncSubprocess(unittest.TestCase):
+    def test_async_subprocess_check(self):
+        self.assertEqual('err\nout\n', asyncio.run(async_subprocess_check('echo out; echo err >&2')))
+        self.assertEqual('out\n', asyncio.run(async_subprocess_check(['echo', 'out'])))
+        self.assertEqual('', asyncio.run(async_subprocess_check('exit 3', ignore_error=True)))
+        with self.assertRaises(Exception):
+            asyncio.run(async_subprocess_check('exit 3'))
+
+    def test_run_many(self):
+        # Each command waits up to 10 seconds for all 4 to have started, so they must overlap
+        dir = tempfile.mkdtemp()
+        cmds = ['touch %s/%d; for t in $(seq 200); do [ $(ls %s | wc -l) -ge 4 ] && break; sleep 0.05; done; '
+                '[ $(ls %s | wc -l) -ge 4 ] && echo %d' % (dir, i, dir, dir, i) for i in range(4)]
+        self.assertEqual(['0\n', '1\n', '2\n', '3\n'], run_many(cmds, limit=4))
+        shutil.rmtree(dir)
+
+    # Benchmark:  4 half-second commands, run one after another vs. with run_many
+    @benchmark
+    def test_run_many_benchmark(self):
+        cmds = ['sleep 0.5; echo %d' % i for i in range(4)]
+        start = time.time()
+        sequential = [subprocess_check(cmd) for cmd in cmds]
+        sequential_secs = time.time() - start
+        start = time.time()
+        overlapped = run_many(cmds, limit=4)
+        overlapped_secs = time.time() - start
+        print('4 commands: sequential %.2f seconds, run_many %.2f seconds' % (sequential_secs, overlapped_secs))
+        self.assertEqual(['0\n', '1\n', '2\n', '3\n'], overlapped)
+        self.assertEqual(sequential, overlapped)
+        self.assertLess(overlapped_secs, sequential_secs / 2)
+
+    def test_run_many_raises_after_all_finish(self):
+        marker = os.path.join(tempfile.mkdtemp(), 'marker')
+        with self.assertRaises(Exception):
+            run_many(['exit 1', 'sleep 0.3; touch %s' % marker])
+        self.assertTrue(os.path.exists(marker))
+        self.assertEqual(['', 'ok\n'], run_many(['exit 1', 'echo ok'], ignore_error=True))
+
+def sleep_and_return(i):
+    # Complete futures out of order
+    time.sleep(0.1 * (i * 7 % 10))
+    return i
+
+def identity(i):
+    return i
+
+class TestSimpleExecutorOrder(unittest.TestCase):
+    def test_ordered_results(self):
+        for pool_type in [SimpleThreadPoolExecutor, SimpleProcessPoolExecutor]:
+            pool = pool_type(10)
+            for i in range(10):
+                pool.submit(sleep_and_return, i)
+            self.assertEqual(list(range(10)), pool.shutdown())
+
+    def test_unordered_results(self):
+        pool = SimpleThreadPoolExecutor(10)
+        for i in range(10):
+            pool.submit(sleep_and_return, i)
+        results = pool.shutdown(ordered=False)
+        self.assertEqual(list(range(10)), sorted(results))
+        # sleep_and_return(0) finishes first and sleep_and_return(7) last
+        self.assertEqual((0, 7), (results[0], results[-1]))
+
+    # Benchmark:  cost of restoring submission order for 10k tasks
+    def test_ordered_overhead(self):
+        for pool_type in [SimpleThreadPoolExecutor, SimpleProcessPoolExecutor]:
+            timings = {}
+            for ordered in [False, True, False, True]:
+                pool = pool_type(4)
+                start = time.time()
+                for i in range(10000):
+                    pool.submit(identity, i)
+                results = pool.shutdown(ordered=ordered)
+                timings[ordered] = min(timings.get(ordered, float('inf')), time.time() - start)
+                if ordered:
+                    self.assertEqual(list(range(10000)), results)
+            print('%s 10k tasks: completion order %.3f seconds, submission order %.3f seconds' %
+                  (pool_type.__name__, timings[False], timings[True]))
+            self.assertLess(timings[True], timings[False] * 1.5 + 0.1)
+
+def square_or_fail(i):
+    if i % 1000 == 999:
+        raise ValueError(i)
+    return i * i
+
+class TestExecutorStats(unittest.TestCase):
+    def test_stats(self):
+        for pool_type in [SimpleThreadPoolExecutor, SimpleProcessPoolExecutor]:
+            pool = pool_type(4)
+            for i in range(8):
+                pool.submit(time.sleep, 0.2)
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                pool.shutdown()
+            # Stats are kept in pool.stats, but only printed if asked
+            self.assertNotIn('stats:', out.getvalue())
+            stats = pool.stats
+            self.assertEqual(8, stats.jobs)
+            self.assertAlmostEqual(0.2, stats.run['p50'], delta=0.05)
+            # The second 4 jobs wait for the first 4
+            self.assertGreater(stats.queue_wait['p99'], 0.15)
+            self.assertGreater(stats.wall['max'], 0.35)
+            self.assertGreater(stats.busy_fraction, 0.5)
+            self.assertLessEqual(stats.busy_fraction, 1)
+            self.assertAlmostEqual(8 / stats.seconds, stats.jobs_per_sec)
+            self.assertIn('8 jobs', str(stats))
+        pool = SimpleThreadPoolExecutor(1)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            pool.shutdown(print_stats=True)
+        self.assertIn('SimpleThreadPoolExecutor stats: 0 jobs', out.getvalue())
+
+    # Only the attempt whose result is used counts, not one that timed out and finished late
+    def test_stats_timeout(self):
+        attempts = []
+        def slow_once():
+            attempts.append(1)
+            time.sleep(0.3 if len(attempts) == 1 else 0)
+            return len(attempts)
+        pool = SimpleThreadPoolExecutor(2, timeout=0.1, retries=1, retry_delay=0)
+        future = pool.submit(slow_once)
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual([2], pool.shutdown())
+        self.assertEqual(2, future.result())
+        time.sleep(0.4)
+        self.assertEqual(1, pool.get_stats().jobs)
+        self.assertLess(pool.get_stats().run['max'], 0.1)
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        values = [i / 1000 for i in range(1, 100001)]
+        for value in values:
+            histogram.add(value)
+        approx = histogram.percentiles()
+        self.assertEqual(100, approx['max'])
+        # Within a bucket of the nearest-rank percentiles
+        for (p, exact) in [('p50', 50), ('p95', 95), ('p99', 99)]:
+            self.assertAlmostEqual(exact, approx[p], delta=exact * 0.05)
+        self.assertAlmostEqual(sum(values), histogram.total)
+        # Fixed number of buckets, however many values
+        self.assertLess(len(histogram.counts), 300)
+        self.assertEqual({'p50': 0, 'p95': 0, 'p99': 0, 'max': 0}, LatencyHistogram().percentiles())
+
+    # Benchmark:  stats are recorded for every job, so check they are cheap with many tiny jobs
+    def test_overhead(self):
+        pool = SimpleProcessPoolExecutor(4)
+        start = time.time()
+        for i in range(20000):
+            pool.submit(identity, i)
+        pool.shutdown()
+        print('20k tiny jobs with stats: %.3f seconds' % (time.time() - start))
+        self.assertEqual(20000, pool.stats.jobs)
+        # Stats don't keep anything per job
+        self.assertLess(sum(len(h.counts) for h in [pool._queue_wait, pool._run, pool._wall]), 3 * LatencyHistogram.max_bucket)
+
+class TestMapChunked(unittest.TestCase):
+    def test_map_chunked(self):
+        pool = SimpleProcessPoolExecutor(4)
+        self.assertEqual(list(range(20000)), pool.map_chunked(identity, range(20000)))
+        self.assertEqual(list(range(0, 200, 2)), pool.map_chunked(abs, range(0, -200, -2), chunksize=7))
+        self.assertEqual([], pool.shutdown())
+
+    # Benchmark:  20k tiny jobs, submitted one at a time vs. through map_chunked
+    @benchmark
+    def test_map_chunked_benchmark(self):
+        pool = SimpleProcessPoolExecutor(4)
+        start = time.time()
+        for i in range(20000):
+            pool.submit(identity, i)
+        self.assertEqual(list(range(20000)), pool.shutdown())
+        submit_secs = time.time() - start
+
+        pool = SimpleProcessPoolExecutor(4)
+        start = time.time()
+        self.assertEqual(list(range(20000)), pool.map_chunked(identity, range(20000)))
+        chunked_secs = time.time() - start
+        pool.shutdown()
+        print('20k tiny jobs: submit %.3f seconds, map_chunked %.3f seconds' % (submit_secs, chunked_secs))
+        self.assertLess(chunked_secs, submit_secs)
+
+    def test_map_chunked_exceptions(self):
+        pool = SimpleProcessPoolExecutor(4)
+        with self.assertRaisesRegex(Exception, 'map_chunked failed: 5 of 5000 raised exception'):
+            pool.map_chunked(square_or_fail, range(5000), chunksize=100)
+        pool.shutdown()
+
+    def test_auto_chunksize(self):
+        self.assertEqual(1000, auto_chunksize(0.0001, 1000000, 4))
+        self.assertEqual(63, auto_chunksize(0.0001, 1000, 4))
+        self.assertEqual(1, auto_chunksize(1, 1000, 4))
+
+def make_array(n):
+    import numpy as np
+    return np.arange(n, dtype=np.float64)
+
+def make_results(n):
+    import numpy as np, pandas as pd
+    df = pd.DataFrame({'i': np.arange(n), 'x': np.arange(n) * 0.5, 's': ['tile'] * n}, index=np.arange(n) * 2)
+    return {'array': make_array(n), 'frames': [df], 'small': (np.ones(3), 'label')}
+
+def make_arrow(n):
+    import pyarrow as pa
+    return pa.table({'i': make_array(n), 's': ['tile'] * n})
+
+def make_unpicklable(n):
+    return (make_array(n), threading.Lock())
+
+def shared_memory_segments():
+    return set(os.listdir('/dev/shm'))
+
+class TestSharedMemory(unittest.TestCase):
+    def assertResultsEqual(self, expected, actual):
+        self.assertTrue((expected['array'] == actual['array']).all())
+        self.assertTrue(expected['frames'][0].equals(actual['frames'][0]))
+        self.assertTrue((expected['small'][0] == actual['small'][0]).all())
+        self.assertEqual('label', actual['small'][1])
+
+    def test_prcall(self):
+        before = shared_memory_segments()
+        results = PrCall(SharedMemoryResult(make_results), 200000).value()
+        self.assertResultsEqual(make_results(200000), results)
+        # Segments are unlinked as soon as the parent maps them
+        self.assertEqual(before, shared_memory_segments())
+
+    def test_arrow(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest('pyarrow not installed')
+        table = PrCall(SharedMemoryResult(make_arrow), 200000).value()
+        self.assertTrue(make_arrow(200000).equals(table))
+
+    def test_pool(self):
+        before = shared_memory_segments()
+        pool = SimpleProcessPoolExecutor(2, shared_memory_results=True)
+        for n in [10, 200000, 300000]:
+            pool.submit(make_results, n)
+        for (n, results) in zip([10, 200000, 300000], pool.shutdown()):
+            self.assertResultsEqual(make_results(n), results)
+        self.assertEqual(before, shared_memory_segments())
+
+    def test_unpicklable(self):
+        before = shared_memory_segments()
+        with self.assertRaisesRegex(TypeError, 'pickle'):
+            PrCall(SharedMemoryResult(make_unpicklable), 200000).value()
+        pool = SimpleProcessPoolExecutor(2, shared_memory_results=True)
+        pool.submit(make_unpicklable, 200000)
+        with self.assertRaisesRegex(Exception, '1 of 1 raised'):
+            pool.shutdown()
+        self.assertEqual(before, shared_memory_segments())
+
+    # A PrCall whose value is never read leaves its segments to the parent's resource tracker
+    def test_unread(self):
+        before = shared_memory_segments()
+        code = ('import utils, test_utils\n'
+                'call = utils.PrCall(utils.SharedMemoryResult(test_utils.make_array), 200000)\n'
+                'call.join()\n')
+        subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                       check=True, stderr=subprocess.DEVNULL)
+        for _ in range(50):
+            if before == shared_memory_segments():
+                break
+            time.sleep(0.1)
+        self.assertEqual(before, shared_memory_segments())
+
+    # Benchmark:  returning a 100MB array from a child process, pickled vs. through shared memory
+    def test_benchmark(self):
+        n = 100 * 1024 * 1024 // 8
+        timings = {}
+        for (label, fn) in [('pickled', make_array), ('shared memory', SharedMemoryResult(make_array))]:
+            for _ in range(2):
+                start = time.time()
+                array = PrCall(fn, n).value()
+                timings[label] = min(timings.get(label, float('inf')), time.time() - start)
+                self.assertEqual((n, n - 1), (len(array), array[-1]))
+                del array
+        print('100MB array from PrCall: pickled %.3f seconds, shared memory %.3f seconds' %
+              (timings['pickled'], timings['shared memory']))
+        self.assertLess(timings['shared memory'], timings['pickled'])
+
+def fail_with(message):
+    raise ValueError(message)
+
+class TestCallAsync(unittest.TestCase):
+    def test_value(self):
+        for kind in ['thread', 'process']:
+            calls = [call_async(identity, i, kind=kind) for i in range(10)]
+            self.assertEqual(list(range(10)), [call.value() for call in calls])
+            self.assertEqual(['a', 'b'], call_async(sorted, ['b', 'a'], kind=kind).value())
+            with self.assertRaisesRegex(ValueError, 'relayed'):
+                call_async(fail_with, 'relayed', kind=kind).value()
+        # Pools persist between calls
+        self.assertIs(async_pool('process'), async_pool('process'))
+
+    def test_shared_memory(self):
+        array = call_async(SharedMemoryResult(make_array), 200000, kind='process').value()
+        self.assertEqual((200000, 199999), (len(array), array[-1]))
+
+    # Benchmark:  calls/sec of ThCall and PrCall vs. call_async on the persistent pools
+    @benchmark
+    def test_benchmark(self):
+        call_async(identity, 0, kind='process').value()  # Start the pool
+        for (kind, call_type, n) in [('thread', ThCall, 2000), ('process', PrCall, 100)]:
+            rates = {}
+            for (label, call) in [(call_type.__name__, call_type), ('call_async', lambda fn, i: call_async(fn, i, kind=kind))]:
+                start = time.time()
+                self.assertEqual(list(range(n)), [call(identity, i).value() for i in range(n)])
+                rates[label] = n / (time.time() - start)
+            print('%s calls/sec: %s %.0f, call_async %.0f' % (kind, call_type.__name__, rates[call_type.__name__], rates['call_async']))
+        self.assertGreater(rates['call_async'], rates['PrCall'] * 5)
+
+class TestSimpleThreadPoolExecutor(unittest.TestCase):
+    def test_max_in_flight(self):
+        pool = SimpleThreadPoolExecutor(4, max_in_flight=8)
+        lock = threading.Lock()
+        queued = 0
+        max_queued = 0
+        def job(i):
+            nonlocal queued
+            time.sleep(0.001)
+            with lock:
+                queued -= 1
+            return i
+        def producer():
+            nonlocal queued, max_queued
+            for i in range(500):
+                with lock:
+                    queued += 1
+                    max_queued = max(max_queued, queued)
+                pool.submit(job, i)
+                self.assertLessEqual(len(pool.get_futures()), 8)
+        thread = threading.Thread(target=producer)
+        thread.start()
+        results = []
+        while thread.is_alive() or pool.get_futures():
+            results.extend(pool.results_as_completed())
+        thread.join()
+        results.extend(pool.shutdown())
+        self.assertEqual(list(range(500)), sorted(results))
+        # One past the limit can be counted by the producer while it waits in submit
+        self.assertLessEqual(max_queued, 9)
+
+    def test_imap(self):
+        def job(i):
+            time.sleep(0.001 * (i * 7 % 10))
+            return i * i
+        pool = SimpleThreadPoolExecutor(4, max_in_flight=6)
+        self.assertEqual([i * i for i in range(100)], list(pool.imap(job, range(100))))
+        self.assertEqual(sorted(i * i for i in range(100)), sorted(pool.imap(job, range(100), ordered=False)))
+        self.assertEqual([], pool.shutdown())
+
+    def test_imap_is_lazy(self):
+        submitted = []
+        def items():
+            for i in range(1000):
+                submitted.append(i)
+                yield i
+        pool = SimpleThreadPoolExecutor(2)
+        results = pool.imap(lambda i: i, items())
+        self.assertEqual(0, next(results))
+        self.assertLess(len(submitted), 10)
+        self.assertEqual(list(range(1, 1000)), list(results))
+        pool.shutdown()
+
+    def test_exceptions(self):
+        def job(i):
+            if i % 3 == 0:
+                raise ValueError(i)
+            return i
+        pool = SimpleThreadPoolExecutor(4, max_in_flight=4)
+        self.assertEqual([1, 2, 4, 5], list(pool.imap(job, range(6))))
+        with self.assertRaisesRegex(Exception, '2 of 6 raised exception'):
+            pool.shutdown()
+
+    def test_retries(self):
+        attempts = collections.Counter()
+        def job(i):
+            attempts[i] += 1
+            if i % 2 and attempts[i] < 3:
+                raise ConnectionError(i)
+            if i == 4:
+                raise ValueError(i)
+            return i
+        pool = SimpleThreadPoolExecutor(4, retries=2, retry_on=(ConnectionError,), retry_delay=0.01)
+        for i in range(6):
+            pool.submit(job, i)
+        # Odd jobs succeed on their third attempt;  ValueError isn't retried
+        with self.assertRaisesRegex(Exception, r'1 of 6 raised exception \(6 retries\)'):
+            pool.shutdown()
+        self.assertEqual([1, 3, 1, 3, 1, 3], [attempts[i] for i in range(6)])
+
+    def test_timeout(self):
+        release = threading.Event()
+        def job(i):
+            if i == 0:
+                release.wait()
+            return i
+        pool = SimpleThreadPoolExecutor(2, timeout=0.2)
+        futures = [pool.submit(job, i) for i in range(4)]
+        start = time.time()
+        with self.assertRaisesRegex(Exception, r'1 of 4 raised exception \(1 timed out\)'):
+            pool.shutdown()
+        self.assertLess(time.time() - start, 2)
+        self.assertIsInstance(futures[0].exception(), TimeoutError)
+        release.set()
+
+    def test_max_failures(self):
+        calls = []
+        def job(i):
+            calls.append(i)
+            time.sleep(0.01)
+            raise ValueError(i)
+        pool = SimpleThreadPoolExecutor(4, max_failures=5)
+        for i in range(2000):
+            pool.submit(job, i)
+        with self.assertRaisesRegex(Exception, r'of 2000 raised exception \(\d+ cancelled\)'):
+            pool.shutdown()
+        self.assertLess(len(calls), 100)
+
+    def test_cancel_pending(self):
+        release = threading.Event()
+        pool = SimpleThreadPoolExecutor(1)
+        futures = [pool.submit(release.wait) for i in range(5)]
+        self.assertEqual(4, pool.cancel_pending())
+        release.set()
+        self.assertTrue(futures[0].result())
+        self.assertTrue(all(future.cancelled() for future in futures[1:]))
+        self.assertTrue(pool.submit(identity, 1).cancelled())
+        with self.assertRaisesRegex(Exception, r'0 of 6 raised exception \(5 cancelled\)'):
+            pool.shutdown()
+
+# Local stand-in for stat.createlab.org, taking POSTs to /api/log over keep-alive connections
+class LocalStatServer(http.server.ThreadingHTTPServer):
+    def __init__(self, delay=0, status=200):
+        super().__init__(('127.0.0.1', 0), LocalStatHandler)
+        self.delay = delay
+        self.status = status
+        self.lock = threading.Lock()
+        self.entries = []
+        self.connections = set()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def api_prefix(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+
+class LocalStatHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go in separate writes;  don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        entry = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(server.delay)
+        with server.lock:
+            server.connections.add(self.client_address)
+            if server.status == 200:
+                server.entries.append(entry)
+        self.send_response(server.status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+class TestStat(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.spool_path = self.dir + '/spool.jsonl'
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_background(self):
+        with LocalStatServer(delay=0.002) as server:
+            stat = StatInstance(api_prefix=server.api_prefix(), spool_path=self.spool_path)
+            start = time.time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(200):
+                    stat.info('summary %d' % i, host='testhost', service='test')
+            per_call = (time.time() - start) / 200
+            self.assertTrue(stat.flush(10))
+            print('Stat.info returned in %.1f microseconds per call' % (per_call * 1e6))
+            self.assertLess(per_call, 0.002)
+            self.assertEqual(['summary %d' % i for i in range(200)], [entry['summary'] for entry in server.entries])
+            # All sent over one keep-alive connection
+            self.assertEqual(1, len(server.connections))
+
+    def test_spool_and_replay(self):
+        with LocalStatServer(status=503) as server:
+            stat = StatInstance(api_prefix=server.api_prefix(), spool_path=self.spool_path, retry_secs=0.2)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(3):
+                    stat.up('up %d' % i, host='testhost', service='test')
+                self.assertTrue(stat.flush(10))
+                self.assertEqual(3, len(open(self.spool_path).readlines()))
+                server.status = 200
+                time.sleep(0.3)
+                stat.up('up 3', host='testhost', service='test')
+                self.assertTrue(stat.flush(10))
+            self.assertEqual(['up 0', 'up 1', 'up 2', 'up 3'], sorted(entry['summary'] for entry in server.entries))
+            self.assertFalse(os.path.exists(self.spool_path))
+
+    def test_queue_full(self):
+        with LocalStatServer(delay=0.2) as server:
+            stat = StatInstance(api_prefix=server.api_prefix(), spool_path=self.spool_path, max_queue=1)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(5):
+                    stat.info('info %d' % i, host='testhost', service='test')
+            # Entries that didn't fit in the queue were spooled rather than blocking
+            self.assertGreaterEqual(len(open(self.spool_path).readlines()), 3)
+            stat.flush(10)
+
+    def test_coalesce(self):
+        with LocalStatServer() as server:
+            stat = StatInstance(api_prefix=server.api_prefix(), spool_path=self.spool_path, coalesce_secs=0.3)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(100):
+                    stat.up('ok', payload={'i': i}, host='testhost', service='test')
+                self.assertTrue(stat.flush(10))
+                # The first is sent right away, and the rest held back
+                self.assertEqual(1, len(server.entries))
+                time.sleep(0.5)
+                self.assertTrue(stat.flush(10))
+            self.assertEqual([None, 99], [entry.get('count') for entry in server.entries])
+            self.assertEqual({'i': 99}, server.entries[1]['payload'])
+
+    def test_coalesce_level_change(self):
+        with LocalStatServer() as server:
+            stat = StatInstance(api_prefix=server.api_prefix(), spool_path=self.spool_path, coalesce_secs=60)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for level in ['up'] * 10 + ['down'] * 3 + ['up']:
+                    stat.log('test', level, level, host='testhost')
+                stat.info('other host', host='otherhost', service='test')
+                self.assertTrue(stat.flush(10))
+                self.assertEqual([('up', None), ('up', 9), ('down', None), ('down', 2), ('up', None), ('info', None)],
+                                 [(entry['level'], entry.get('count')) for entry in server.entries])
+                stat.info('other host', host='otherhost', service='test')
+                stat.flush_coalesced()
+                self.assertTrue(stat.flush(10))
+            self.assertEqual(('otherhost', 1), (server.entries[-1]['host'], server.entries[-1]['count']))
+
+    def test_coalesce_info_between_states(self):
+        with LocalStatServer() as server:
+            stat = StatInstance(api_prefix=server.api_prefix(), spool_path=self.spool_path, coalesce_secs=60)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for i in range(50):
+                    stat.up('ok', host='testhost', service='test')
+                    stat.info('processed batch', host='testhost', service='test')
+                self.assertTrue(stat.flush(10))
+                # info neither counts as a state change nor breaks coalescing of up
+                self.assertEqual([('up', None), ('info', None)], [(entry['level'], entry.get('count')) for entry in server.entries])
+                stat.flush_coalesced()
+                self.assertTrue(stat.flush(10))
+            self.assertEqual([('info', 49), ('up', 49)], sorted((entry['level'], entry['count']) for entry in server.entries[2:]))
+
+    def test_synchronous(self):
+        with LocalStatServer() as server:
+            stat = StatInstance(api_prefix=server.api_prefix(), spool_path=self.spool_path, background=False)
+            with contextlib.redirect_stdout(io.StringIO()):
+                stat.warning('now', host='testhost', service='test')
+            self.assertEqual('warning', server.entries[0]['level'])
+            # Failed entries are spooled, and replayed after the next successful post
+            server.status = 500
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                stat.critical('failed', host='testhost', service='test')
+                self.assertEqual(1, len(open(self.spool_path).readlines()))
+                server.status = 200
+                stat.up('recovered', host='testhost', service='test')
+            self.assertEqual(['now', 'recovered', 'failed'], [entry['summary'] for entry in server.entries])
+            self.assertFalse(os.path.exists(self.spool_path))
+
+    def test_bad_spool_line(self):
+        good = json.dumps(dict(service='test', host='testhost', level='up', summary='spooled'))
+        for background in [False, True]:
+            with open(self.spool_path, 'w') as spool:
+                spool.write(good + '\n' + good[:20] + '\n' + good + '\n')
+            with LocalStatServer() as server:
+                stat = StatInstance(api_prefix=server.api_prefix(), spool_path=self.spool_path,
+                                    background=background, retry_secs=0.1)
+                with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()) as stderr:
+                    stat.up('first', host='testhost', service='test')
+                    self.assertTrue(stat.flush(10))
+                    time.sleep(0.3)
+                    stat.up('second', host='testhost', service='test')
+                    self.assertTrue(stat.flush(10))
+            # The line that doesn't parse is reported and kept, and the rest are sent
+            self.assertIn("doesn't parse", stderr.getvalue())
+            self.assertEqual(['first', 'second', 'spooled', 'spooled'], sorted(entry['summary'] for entry in server.entries))
+            self.assertEqual([good[:20] + '\n'], open(self.spool_path).readlines())
+            self.assertEqual(['spool.jsonl'], os.listdir(self.dir))
+
+    def test_private_spool(self):
+        spool_dir = os.path.join(self.dir, 'stat-spool')
+        with unittest.mock.patch('utils.stat_spool_dir', spool_dir), LocalStatServer(status=503) as server:
+            stat = StatInstance(api_prefix=server.api_prefix(), background=False)
+            self.assertEqual(spool_dir, os.path.dirname(stat.spool_path))
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()) as stderr:
+                stat.down('spooled', host='testhost', service='test')
+                self.assertEqual(0o700, os.stat(spool_dir).st_mode & 0o777)
+                self.assertEqual(1, len(open(stat.spool_path).readlines()))
+                # A spool directory others can write to isn't used, and spooling errors aren't raised
+                os.chmod(spool_dir, 0o777)
+                stat.down('dropped', host='testhost', service='test')
+            self.assertIn('not private', stderr.getvalue())
+            self.assertEqual(1, len(open(stat.spool_path).readlines()))
+
+class TestStopwatch(unittest.TestCase):
+    def test_nesting(self):
+        profile = StopwatchProfile()
+        def work(name):
+            with Stopwatch('outer', verbose=False, profile=profile):
+                for i in range(3):
+                    with Stopwatch('inner', verbose=False, profile=profile):
+                        time.sleep(0.01)
+                with Stopwatch(name, verbose=False, profile=profile):
+                    pass
+        work('a')
+        # Each thread starts its own tree
+        thread = threading.Thread(target=work, args=('b',))
+        thread.start()
+        thread.join()
+        stats = profile.stats()
+        self.assertEqual({('outer',), ('outer', 'inner'), ('outer', 'a'), ('outer', 'b')}, set(stats))
+        self.assertEqual(2, stats[('outer',)]['count'])
+        self.assertEqual(6, stats[('outer', 'inner')]['count'])
+        inner = stats[('outer', 'inner')]
+        self.assertAlmostEqual(inner['total'] / 6, inner['mean'])
+        self.assertGreaterEqual(inner['max'], 0.01)
+        self.assertLess(stats[('outer',)]['self'], stats[('outer',)]['total'] - 0.05)
+
+        lines = profile.collapsed_stacks().splitlines()
+        self.assertEqual(['outer', 'outer;a', 'outer;b', 'outer;inner'], [line.split(' ')[0] for line in lines])
+        self.assertAlmostEqual(inner['self'] * 1e6, int(lines[3].split(' ')[1]), delta=1)
+
+        [outer] = profile.to_json()
+        self.assertEqual(('outer', 2), (outer['name'], outer['count']))
+        self.assertEqual(['a', 'b', 'inner'], [child['name'] for child in outer['children']])
+
+    def test_asyncio_tasks(self):
+        profile = StopwatchProfile()
+        async def task():
+            with Stopwatch('task', verbose=False, profile=profile):
+                await asyncio.sleep(0.01)
+        async def main():
+            with Stopwatch('main', verbose=False, profile=profile):
+                await asyncio.gather(task(), task())
+        asyncio.run(main())
+        self.assertEqual(2, profile.stats()[('main', 'task')]['count'])
+
+    def test_verbose(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            with Stopwatch('quiet', verbose=False, profile=StopwatchProfile()):
+                pass
+            with Stopwatch('loud', profile=StopwatchProfile()):
+                pass
+        self.assertEqual('loud took', output.getvalue()[:9])
+        self.assertNotIn('quiet', output.getvalue())
+
+    def test_fields(self):
+        with Stopwatch('sleep', verbose=False, profile=StopwatchProfile()) as sleep:
+            time.sleep(0.2)
+        self.assertGreaterEqual(sleep.seconds, 0.2)
+        self.assertLess(sleep.cpu_efficiency, 0.5)
+
+        with tempfile.TemporaryDirectory() as dir:
+            with Stopwatch('busy', verbose=False, profile=StopwatchProfile(), resources=True) as busy:
+                start = time.time()
+                while time.time() - start < 0.2:
+                    pass
+                with open(dir + '/file', 'wb') as f:
+                    f.write(b'x' * 1000000)
+        self.assertGreater(busy.cpu_efficiency, 0.5)
+        self.assertGreater(busy.thread_cpu_seconds, 0.1)
+        self.assertGreater(busy.peak_rss_bytes, 1000000)
+        if busy.write_bytes is not None:
+            self.assertGreaterEqual(busy.write_bytes, 1000000)
+        self.assertEqual(['name', 'seconds', 'cpu_seconds', 'thread_cpu_seconds', 'cpu_efficiency',
+                          'peak_rss_bytes', 'read_bytes', 'write_bytes'], list(busy.stats()))
+
+    def test_dump(self):
+        profile = StopwatchProfile()
+        with Stopwatch('a;b', verbose=False, profile=profile):
+            pass
+        with tempfile.TemporaryDirectory() as dir:
+            profile.dump(dir + '/profile.json')
+            self.assertEqual('a;b', json.load(open(dir + '/profile.json'))[0]['name'])
+            profile.dump(dir + '/profile.txt')
+            self.assertEqual('a,b', open(dir + '/profile.txt').read().split(' ')[0])
+
+    def test_opt_in(self):
+        # Stopwatches aren't recorded unless a profile is set
+        with Stopwatch('unprofiled', verbose=False):
+            pass
+        self.assertEqual({}, stopwatch_profile.stats())
+        profile = StopwatchProfile(max_paths=3)
+        with unittest.mock.patch.object(Stopwatch, 'profile', profile):
+            for i in range(10):
+                with Stopwatch('fetched %d records' % i, verbose=False):
+                    pass
+        # Paths beyond max_paths are aggregated together
+        stats = profile.stats()
+        self.assertEqual(4, len(stats))
+        self.assertEqual(7, stats[StopwatchProfile.overflow_path]['count'])
+
+def write_notebook(filename, cells):
+    with open(filename, 'w') as f:
+        json.dump({'nbformat': 4, 'nbformat_minor': 2, 'metadata': {},
+                   'cells': [{'cell_type': 'code', 'source': cell, 'metadata': {}, 'outputs': []} for cell in cells]}, f)
+
+class TestExecIpynb(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = self.dir + '/cache'
+        self.patch = unittest.mock.patch('utils.exec_ipynb_cache_dir', self.cache_dir)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.dir)
+
+    def test_cache(self):
+        notebook = self.dir + '/test.ipynb'
+        write_notebook(notebook, ['exec_ipynb_test_value = 1\n', 'exec_ipynb_test_value += 1'])
+        exec_ipynb(notebook)
+        self.assertEqual(2, globals().pop('exec_ipynb_test_value'))
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+        # A cache hit runs the cached code without parsing the notebook
+        with unittest.mock.patch('json.loads', side_effect=AssertionError('parsed notebook')):
+            exec_ipynb(notebook)
+        self.assertEqual(2, globals().pop('exec_ipynb_test_value'))
+        # Changing the notebook changes its hash
+        write_notebook(notebook, ['exec_ipynb_test_value = 3'])
+        exec_ipynb(notebook)
+        self.assertEqual(3, globals().pop('exec_ipynb_test_value'))
+        self.assertEqual(4, len(os.listdir(self.cache_dir)))
+
+    def test_prune(self):
+        (old, new) = (self.dir + '/old.ipynb', self.dir + '/new.ipynb')
+        write_notebook(old, ['exec_ipynb_test_value = 1'])
+        exec_ipynb(old)
+        self.assertEqual(1, globals().pop('exec_ipynb_test_value'))
+        stale = time.time() - exec_ipynb_cache_max_age_secs - 60
+        for name in os.listdir(self.cache_dir):
+            os.utime(os.path.join(self.cache_dir, name), (stale, stale))
+        # Entries unused for too long are removed when a new one is written
+        write_notebook(new, ['exec_ipynb_test_value = 2'])
+        exec_ipynb(new)
+        self.assertEqual(2, globals().pop('exec_ipynb_test_value'))
+        self.assertEqual(['new.ipynb'] * 2, [name.split('-')[0] for name in os.listdir(self.cache_dir)])
+        # A cache hit marks its entry used
+        stale = time.time() - exec_ipynb_cache_max_age_secs / 2
+        for name in os.listdir(self.cache_dir):
+            os.utime(os.path.join(self.cache_dir, name), (stale, stale))
+        exec_ipynb(new)
+        self.assertEqual(2, globals().pop('exec_ipynb_test_value'))
+        self.assertTrue(all(os.path.getmtime(os.path.join(self.cache_dir, name)) > stale + 60 for name in os.listdir(self.cache_dir)))
+
+    def test_untrusted_cache(self):
+        notebook = self.dir + '/test.ipynb'
+        write_notebook(notebook, ['exec_ipynb_test_value = 1'])
+        exec_ipynb(notebook)
+        self.assertEqual(1, globals().pop('exec_ipynb_test_value'))
+        # Replace the cached code, then let others write to the cache:  the code is not trusted
+        [code_path] = [name for name in os.listdir(self.cache_dir) if name.endswith('.marshal')]
+        with open(os.path.join(self.cache_dir, code_path), 'wb') as f:
+            f.write(marshal.dumps(compile('exec_ipynb_test_value = "planted"', 'planted', 'exec')))
+        os.chmod(self.cache_dir, 0o777)
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            exec_ipynb(notebook)
+        self.assertEqual(1, globals().pop('exec_ipynb_test_value'))
+        self.assertIn('not private', stderr.getvalue())
+
+    def test_traceback(self):
+        notebook = self.dir + '/fails.ipynb'
+        write_notebook(notebook, ['x = 1\n', 'def fail():\n    raise ValueError("in notebook")\n', 'fail()'])
+        try:
+            exec_ipynb(notebook)
+            self.fail('exec_ipynb should raise')
+        except ValueError as e:
+            frame = traceback.extract_tb(e.__traceback__)[-1]
+        self.assertTrue(frame.filename.startswith(self.cache_dir + '/fails.ipynb-'))
+        self.assertEqual('raise ValueError("in notebook")', frame.line)
+
+    def test_import(self):
+        log = self.dir + '/log'
+        write_notebook(self.dir + '/import-test.ipynb', ['open(%s, "a").write("ran\\n")\n' % repr(log), 'value = 1'])
+        sys.path.insert(0, self.dir)
+        try:
+            import import_test_ipynb
+            import import_test_ipynb as again
+            self.assertIs(import_test_ipynb, again)
+            self.assertEqual(1, import_test_ipynb.value)
+            self.assertEqual(self.dir + '/import-test.ipynb', import_test_ipynb.__file__)
+            # Module-level code runs once
+            self.assertEqual(1, len(open(log).readlines()))
+            write_notebook(self.dir + '/import-test.ipynb', ['value = 2'])
+            reload_module('import_test_ipynb')
+            self.assertEqual(2, import_test_ipynb.value)
+            with self.assertRaises(ModuleNotFoundError):
+                import missing_notebook_ipynb
+        finally:
+            sys.path.remove(self.dir)
+            sys.modules.pop('import_test_ipynb', None)
+
+    # Benchmark:  getting the code of utils.ipynb, cold and cached
+    def test_benchmark(self):
+        start = time.time()
+        ipynb_code('utils.ipynb')
+        cold_secs = time.time() - start
+        start = time.time()
+        for _ in range(10):
+            ipynb_code('utils.ipynb')
+        cached_secs = (time.time() - start) / 10
+        print('ipynb_code(utils.ipynb): cold %.1f ms, cached %.1f ms' % (cold_secs * 1000, cached_secs * 1000))
+        self.assertLess(cached_secs, cold_secs)
+
+if __name__ == '__main__':
+    if 'get_ipython' in vars():
+        test_suite = unittest.TestSuite()
+        test_suite.addTest(unittest.makeSuite(TestDownload))
+        test_suite.addTest(unittest.makeSuite(TestUnzip))
+        test_suite.addTest(unittest.makeSuite(TestSubprocess))
+        test_suite.addTest(unittest.makeSuite(TestAsyncSubprocess))
+        test_suite.addTest(unittest.makeSuite(TestSimpleExecutorOrder))
+        test_suite.addTest(unittest.makeSuite(TestExecutorStats))
+        test_suite.addTest(unittest.makeSuite(TestMapChunked))
+        test_suite.addTest(unittest.makeSuite(TestSharedMemory))
+        test_suite.addTest(unittest.makeSuite(TestCallAsync))
+        test_suite.addTest(unittest.makeSuite(TestSimpleThreadPoolExecutor))
+        test_suite.addTest(unittest.makeSuite(TestStat))
+        test_suite.addTest(unittest.makeSuite(TestStopwatch))
+        test_suite.addTest(unittest.makeSuite(TestExecIpynb))
+        unittest.TextTestRunner().run(test_suite)
+    else:
+        unittest.main()
@@ -1,7 +1,7 @@
 #%%
 
-import concurrent, concurrent.futures, datetime, importlib, inspect, json, math, os, re
-import requests, shutil, subprocess, sys, time, threading, traceback
+import asyncio, atexit, collections, concurrent, concurrent.futures, contextvars, datetime, email.utils, gzip, hashlib, importlib, importlib.abc, importlib.util, inspect, itertools, json, math, os, re
+import marshal, queue, requests, shutil, subprocess, sys, time, threading, traceback, urllib.parse, zipfile
 try:
     import dateutil, dateutil.tz
 except:
@@ -11,20 +11,41 @@ def reload_module(module_name):
     if module_name in sys.modules:
         importlib.reload(sys.modules[module_name])
 
+# Runs a command and returns its standard error followed by its standard out.
+# A single string argument is run with the shell.
+# Raises an exception if the command fails, unless ignore_error=True.
+#
+# With stream=True (or on_line), output is handled line by line as it arrives instead:  each line is
+# passed to on_line(line) (default: printed if verbose), and only the last tail_lines lines of each
+# stream are kept, for the return value and the exception message.  The return value is the kept
+# tail, in arrival order.
 def subprocess_check(*args, **kwargs):
     verbose = kwargs.pop('verbose', False)
     ignore_error = kwargs.pop('ignore_error', False)
+    on_line = kwargs.pop('on_line', None)
+    stream = kwargs.pop('stream', False) or on_line is not None
+    tail_lines = kwargs.pop('tail_lines', 1000)
     if len(args) == 1 and type(args[0]) == str:
         kwargs['shell'] = True
         if verbose:
             print(args[0])
     elif verbose:
         print(' '.join(args[0]))
+    if stream:
+        if on_line is None:
+            on_line = sys.stdout.write if verbose else (lambda line: None)
+        tail = collections.deque(maxlen=tail_lines)
+        for (_, line) in subprocess_lines(*args, ignore_error=ignore_error, tail_lines=tail_lines, **kwargs):
+            tail.append(line)
+            on_line(line)
+        return ''.join(tail)
     p = subprocess.Popen(*args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
     (out, err) = p.communicate()
+    return subprocess_check_output(p.wait(), out, err, verbose, ignore_error)
+
+def subprocess_check_output(ret, out, err, verbose, ignore_error):
     out = out.decode('utf8')
     err = err.decode('utf8')
-    ret = p.wait()
     if ret != 0 and not ignore_error:
         raise Exception(
             ('Call to subprocess_check failed with return code {ret}\n'
@@ -37,35 +58,547 @@ def subprocess_check(*args, **kwargs):
         print(all.strip())
     return all
 
-def download_file(url, filename, timeout=3600, make_parents=True):
-    if os.path.exists(filename):
-        sys.stdout.write('%s already downloaded\n' % filename)
-        return True
+# asyncio counterpart of subprocess_check, with the same arguments, return value and exceptions.
+# A single string argument is run with the shell;  otherwise args[0] is the argument list.
+async def async_subprocess_check(*args, **kwargs):
+    verbose = kwargs.pop('verbose', False)
+    ignore_error = kwargs.pop('ignore_error', False)
+    if len(args) == 1 and type(args[0]) == str:
+        if verbose:
+            print(args[0])
+        p = await asyncio.create_subprocess_shell(
+            args[0], stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
     else:
-        dirname = os.path.dirname(filename)
-        if dirname and make_parents and not os.path.exists(dirname):
-            os.makedirs(dirname)
-        sys.stdout.write('Downloading %s to %s\n' % (url, filename))
+        if verbose:
+            print(' '.join(args[0]))
+        p = await asyncio.create_subprocess_exec(
+            *args[0], stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    (out, err) = await p.communicate()
+    return subprocess_check_output(p.returncode, out, err, verbose, ignore_error)
+
+# Runs each command in cmds (a string for the shell, or an argument list) with async_subprocess_check,
+# at most limit at a time, and returns their outputs in the same order as cmds.
+# kwargs (e.g. verbose, ignore_error, executable) apply to every command.
+# If any command fails, the others are still run to completion, then the first failure is raised.
+def run_many(cmds, limit=8, **kwargs):
+    async def run_all():
+        semaphore = asyncio.Semaphore(limit)
+        async def run(cmd):
+            async with semaphore:
+                return await async_subprocess_check(cmd, **kwargs)
+        return await asyncio.gather(*[run(cmd) for cmd in cmds], return_exceptions=True)
+
+    try:
+        asyncio.get_running_loop()
+        in_event_loop = True
+    except RuntimeError:
+        in_event_loop = False
+    if in_event_loop:
+        # e.g. in Jupyter;  asyncio.run can't nest, so run ours in a separate thread
+        results = ThCall(asyncio.run, run_all()).value()
+    else:
+        results = asyncio.run(run_all())
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+# Runs a command like subprocess_check, yielding (stream, line) tuples as output arrives,
+# where stream is 'stdout' or 'stderr' and line includes its trailing newline.
+# Memory is bounded:  lines longer than max_line_length are split, and only the last tail_lines
+# lines of each stream are kept for the exception raised (after all output is yielded) if the
+# command fails, unless ignore_error=True.
+# If the caller stops iterating early, the command is killed.
+def subprocess_lines(*args, **kwargs):
+    ignore_error = kwargs.pop('ignore_error', False)
+    tail_lines = kwargs.pop('tail_lines', 1000)
+    max_line_length = kwargs.pop('max_line_length', 65536)
+    if len(args) == 1 and type(args[0]) == str:
+        kwargs['shell'] = True
+    p = subprocess.Popen(*args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    lines = queue.Queue(maxsize=1000)
 
+    def reader(pipe, name):
         try:
-            response = requests.Session().get(
-                url, 
-                timeout=timeout,
-                headers={'User-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.128 Safari/537.36'}
-            )
-            if(response.status_code!=200):
-                print('Error response, code = %d, body = %s' % (response.status_code, response.text))
-                return False
+            for line in iter(lambda: pipe.readline(max_line_length), b''):
+                lines.put((name, line.decode('utf8', 'replace')))
+        finally:
+            pipe.close()
+            lines.put((name, None))
+
+    tails = {'stdout': collections.deque(maxlen=tail_lines), 'stderr': collections.deque(maxlen=tail_lines)}
+    for name, pipe in (('stdout', p.stdout), ('stderr', p.stderr)):
+        threading.Thread(target=reader, args=(pipe, name), daemon=True).start()
+    open_streams = 2
+    try:
+        while open_streams:
+            (name, line) = lines.get()
+            if line is None:
+                open_streams -= 1
+                continue
+            tails[name].append(line)
+            yield (name, line)
+        ret = p.wait()
+    finally:
+        if p.poll() is None:
+            p.kill()
+            # Drain so reader threads blocked on a full queue can exit
+            try:
+                while open_streams:
+                    if lines.get(timeout=5)[1] is None:
+                        open_streams -= 1
+            except queue.Empty:
+                pass
+            p.wait()
+    if ret != 0 and not ignore_error:
+        err = ''.join(tails['stderr'])
+        out = ''.join(tails['stdout'])
+        raise Exception(
+            ('Call to subprocess_check failed with return code {ret}\n'
+             'Standard error:\n{err}'
+             'Standard out:\n{out}').format(**locals()))
+
+download_headers = {'User-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.128 Safari/537.36'}
+
+# Downloads url to filename, writing to filename.tmp and renaming when complete.
+# Streams the body to disk in chunk_size pieces, so memory use does not grow with file size.
+# After a dropped connection or server error, retries up to retries times with exponential
+# backoff, resuming from the end of the existing .tmp file with an HTTP Range request.
+# The ETag or Last-Modified of the response that started the .tmp file is saved next to it in
+# .tmp.validator and sent as If-Range, so a resume never splices in a newer version of the file;
+# a .tmp file left by an earlier call is only resumed if it has a validator.
+# stream=False reads the whole body into memory before writing, and does not resume.
+# connections > 1 fetches byte ranges in parallel;  see download_file_parallel.
+# Pass session to reuse pooled connections across calls.
+#
+# By default an existing filename is assumed to be current.  With revalidate=True, the ETag,
+# Last-Modified, size and sha256 of each download are recorded in a DownloadCache (cache, or
+# .download_cache.sqlite next to filename), and an existing file is revalidated with a
+# conditional request, re-downloading only if the server has a newer version.
+def download_file(url, filename, timeout=3600, make_parents=True, stream=True, chunk_size=1024 * 1024,
+                  retries=5, retry_delay=1, connections=1, session=None, min_range_size=1024 * 1024,
+                  revalidate=False, cache=None):
+    if revalidate or cache:
+        cache = download_cache(cache or os.path.join(os.path.dirname(os.path.abspath(filename)),
+                                                     '.download_cache.sqlite'))
+    session = session or pooled_session(connections)
+    if os.path.exists(filename):
+        if not cache:
+            sys.stdout.write('%s already downloaded\n' % filename)
+            return True
+        try:
+            if is_download_current(session, url, filename, cache, timeout):
+                sys.stdout.write('%s not modified\n' % filename)
+                return True
         except requests.exceptions.RequestException as e:
-            sys.stdout.write("Couldn't read %s because %s" % (url, e))
+            sys.stdout.write("Couldn't revalidate %s because %s\n" % (url, e))
             return False
+        sys.stdout.write('%s changed on server\n' % filename)
+        # Don't resume from a partial download that may be of an older version
+        remove_download_tmp(filename + '.tmp')
+    dirname = os.path.dirname(filename)
+    if dirname and make_parents and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    sys.stdout.write('Downloading %s to %s\n' % (url, filename))
 
-        open(filename + '.tmp', "wb").write(response.content)
-        os.rename(filename + '.tmp', filename)
-        sys.stdout.write('Done, wrote %d bytes to %s\n' % (len(response.content), filename))
-        return True
+    tmpname = filename + '.tmp'
+    started = {}  # set by download_to_tmp once this call has started writing tmpname
+    def attempt():
+        if stream:
+            return download_to_tmp(session, url, tmpname, timeout, chunk_size, started)
+        response = session.get(url, timeout=timeout, headers=download_headers)
+        check_download_response(response)
+        open(tmpname, 'wb').write(response.content)
+        return (len(response.content), response.headers)
+
+    start_time = time.time()
+    try:
+        result = None
+        if connections > 1:
+            result = download_ranges_to_tmp(session, url, tmpname, timeout, chunk_size,
+                                            connections, min_range_size, retries, retry_delay)
+        if result is None:
+            result = with_download_retries(url, retries, retry_delay, attempt)
+    except (DownloadError, requests.exceptions.RequestException) as e:
+        sys.stdout.write("Couldn't read %s because %s\n" % (url, e))
+        return False
+    (size, headers) = result
+    elapsed = time.time() - start_time
+
+    os.replace(tmpname, filename)
+    remove_download_tmp(tmpname)  # its validator
+    if cache:
+        cache.record(url, filename, headers.get('ETag'), headers.get('Last-Modified'), size, sha256_file(filename))
+    sys.stdout.write('Done, wrote %d bytes to %s in %.1f seconds (%.1f MB/s)\n'
+                     % (size, filename, elapsed, size / 1e6 / max(elapsed, 1e-6)))
+    return True
+
+# Downloads url to filename over several connections at once, each fetching its own byte range
+# and writing it into place in the preallocated filename.tmp with os.pwrite.
+# Falls back to a single streaming download if the server doesn't support ranges.
+# Other kwargs are as for download_file.
+def download_file_parallel(url, filename, connections=8, **kwargs):
+    return download_file(url, filename, connections=connections, **kwargs)
+
+# Fetches url into tmpname in up to connections parallel byte ranges.
+# Returns (size, headers), or None if the server doesn't support ranges or the file is too small
+# to be worth splitting.  Raises DownloadError/RequestException if a range fails after retries.
+def download_ranges_to_tmp(session, url, tmpname, timeout, chunk_size, connections, min_range_size, retries, retry_delay):
+    try:
+        head = session.head(url, timeout=timeout, allow_redirects=True,
+                            headers=dict(download_headers, **{'Accept-Encoding': 'identity'}))
+        size = int(head.headers.get('Content-Length', -1))
+        ranges_ok = head.status_code == 200 and head.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    except (requests.exceptions.RequestException, ValueError):
+        size, ranges_ok = -1, False
+    connections = min(connections, max(1, size // min_range_size))
+    if not ranges_ok or size <= 0 or connections < 2:
+        return None
 
-def unzip_file(filename):
+    url = head.url  # skip redirects on each range request
+    sys.stdout.write('Fetching %d bytes with %d connections\n' % (size, connections))
+    fd = os.open(tmpname, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, size)
+
+        def fetch_range(start, end):
+            pos = start
+            def attempt():
+                nonlocal pos
+                headers = dict(download_headers, **{'Accept-Encoding': 'identity', 'Range': 'bytes=%d-%d' % (pos, end)})
+                with session.get(url, timeout=timeout, headers=headers, stream=True) as response:
+                    check_download_response(response)
+                    if response.status_code != 206 or parse_content_range(response.headers.get('Content-Range'))[0] != pos:
+                        raise DownloadError('server did not honor Range bytes=%d-%d' % (pos, end), retryable=False)
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        if pos + len(chunk) > end + 1:
+                            raise DownloadError('server sent more than bytes=%d-%d' % (start, end), retryable=False)
+                        os.pwrite(fd, chunk, pos)
+                        pos += len(chunk)
+                if pos <= end:
+                    raise DownloadError('connection closed at byte %d of range %d-%d' % (pos, start, end))
+            with_download_retries(url, retries, retry_delay, attempt)
+            return end + 1 - start
+
+        pool = SimpleThreadPoolExecutor(connections)
+        boundaries = [size * i // connections for i in range(connections + 1)]
+        for i in range(connections):
+            pool.submit(fetch_range, boundaries[i], boundaries[i + 1] - 1)
+        try:
+            pool.shutdown()
+        except Exception as e:
+            # The preallocated .tmp is full-size but has holes;  don't let a later download resume from it
+            os.unlink(tmpname)
+            raise DownloadError(str(e), retryable=False)
+    finally:
+        os.close(fd)
+    return (size, head.headers)
+
+# On-disk index of HTTP validators (ETag, Last-Modified) plus size and sha256 for downloaded files,
+# used by download_file(revalidate=True).  Stored in sqlite at path via SimpleSqlite.
+class DownloadCache:
+    def __init__(self, path):
+        from SimpleSqlite import SimpleSqlite
+        self.path = path
+        self.db = SimpleSqlite(path)
+        self.db.execute_write('CREATE TABLE IF NOT EXISTS downloads ('
+                              'url TEXT, filename TEXT, etag TEXT, last_modified TEXT, size INTEGER, '
+                              'sha256 TEXT, checked REAL, PRIMARY KEY (url, filename))')
+
+    def lookup(self, url, filename):
+        rows = self.db.execute_read_fetchall_dicts('SELECT * FROM downloads WHERE url=? AND filename=?',
+                                                   (url, os.path.abspath(filename)))
+        return rows[0] if rows else None
+
+    def record(self, url, filename, etag, last_modified, size, sha256):
+        self.db.execute_write('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (url, os.path.abspath(filename), etag, last_modified, size, sha256, time.time()))
+
+    def touch(self, url, filename):
+        self.db.execute_write('UPDATE downloads SET checked=? WHERE url=? AND filename=?',
+                              (time.time(), url, os.path.abspath(filename)))
+
+download_caches = {}
+download_caches_lock = threading.Lock()
+
+# Returns the DownloadCache for path, opening it once per process.  cache may also be a DownloadCache.
+def download_cache(cache):
+    if isinstance(cache, DownloadCache):
+        return cache
+    path = os.path.abspath(cache)
+    with download_caches_lock:
+        if path not in download_caches:
+            download_caches[path] = DownloadCache(path)
+        return download_caches[path]
+
+# Checks whether existing filename still matches url, transferring headers only.
+# With validators recorded in cache, sends a conditional GET and treats 304 as current.
+# Without (e.g. files downloaded before the cache existed), HEADs the url and adopts the
+# local file if its size matches and it is no older than the server's Last-Modified.
+def is_download_current(session, url, filename, cache, timeout):
+    entry = cache.lookup(url, filename)
+    local_size = os.path.getsize(filename)
+    if entry and entry['size'] == local_size and (entry['etag'] or entry['last_modified']):
+        headers = dict(download_headers)
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        # stream=True so that a 200 closes without reading the body;  download_file refetches it
+        with session.get(url, timeout=timeout, headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                cache.touch(url, filename)
+                return True
+            return False
+    if entry:
+        return False
+    response = session.head(url, timeout=timeout, headers=download_headers, allow_redirects=True)
+    last_modified = response.headers.get('Last-Modified')
+    if response.status_code != 200 or not last_modified or response.headers.get('Content-Length') != str(local_size):
+        return False
+    try:
+        server_time = email.utils.parsedate_to_datetime(last_modified).timestamp()
+    except (TypeError, ValueError):
+        return False
+    if os.path.getmtime(filename) < server_time:
+        return False
+    cache.record(url, filename, response.headers.get('ETag'), last_modified, local_size, sha256_file(filename))
+    return True
+
+def sha256_file(filename, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Downloads each (url, filename) in pairs, running up to max_workers downloads at once and
+# at most per_host_limit at once from any one host.  Downloads from the same host share a
+# pooled requests.Session.  Files already present are skipped, as in download_file, unless
+# revalidate=True, in which case they are revalidated and re-downloaded only if changed.
+# Failures are collected rather than aborting the batch.
+# Returns a report dict:
+#   files:       per-file dicts of url, filename, status ('downloaded', 'skipped', 'not modified', 'failed'),
+#                seconds, bytes, error
+#   failures:    the subset of files that failed
+#   hosts:       per-host totals of files and bytes, plus seconds and mb_per_sec over the wall-clock span
+#                from that host's first download starting to its last one finishing
+#   seconds, bytes, mb_per_sec:  totals for the whole batch
+# Extra kwargs (e.g. connections, retries, timeout) are passed to download_file.
+def download_files(pairs, max_workers=8, per_host_limit=4, tqdm=None, **kwargs):
+    pairs = list(pairs)
+    by_host = {}
+    for url, filename in pairs:
+        by_host.setdefault(urllib.parse.urlsplit(url).netloc, []).append((url, filename))
+    sessions = {host: pooled_session(per_host_limit) for host in by_host}
+    host_slots = {host: threading.BoundedSemaphore(per_host_limit) for host in by_host}
+
+    revalidating = kwargs.get('revalidate') or kwargs.get('cache')
+    spans = {}
+
+    def download(host, url, filename):
+        record = dict(url=url, filename=filename, status='skipped', seconds=0.0, bytes=0, error=None)
+        before = None
+        if os.path.exists(filename):
+            if not revalidating:
+                sys.stdout.write('%s already downloaded\n' % filename)
+                return record
+            before = os.stat(filename)
+        with host_slots[host]:
+            start = time.time()
+            try:
+                ok = download_file(url, filename, session=sessions[host], **kwargs)
+                if not ok:
+                    record['error'] = 'download_file failed'
+            except Exception as e:
+                ok = False
+                record['error'] = repr(e)
+                sys.stderr.write('download_files: %s raised %s\n' % (url, traceback.format_exc()))
+            end = time.time()
+            record['seconds'] = end - start
+            spans[filename] = (start, end)
+        if ok:
+            after = os.stat(filename)
+            if before and (before.st_ino, before.st_mtime_ns) == (after.st_ino, after.st_mtime_ns):
+                record['status'] = 'not modified'
+            else:
+                record['status'] = 'downloaded'
+                record['bytes'] = after.st_size
+        else:
+            record['status'] = 'failed'
+        return record
+
+    # Interleave hosts so that workers aren't all stuck waiting on one host's limit
+    interleaved = []
+    for batch in itertools.zip_longest(*[[(host, url, filename) for (url, filename) in host_pairs]
+                                         for host, host_pairs in by_host.items()]):
+        interleaved.extend(job for job in batch if job)
+
+    start = time.time()
+    pool = SimpleThreadPoolExecutor(max_workers)
+    for job in interleaved:
+        pool.submit(download, *job)
+    files = pool.shutdown(tqdm=tqdm)
+    seconds = time.time() - start
+    positions = {filename: i for i, (url, filename) in enumerate(pairs)}
+    files.sort(key=lambda record: positions[record['filename']])
+
+    hosts = {}
+    for record in files:
+        if record['status'] == 'downloaded':
+            host = hosts.setdefault(urllib.parse.urlsplit(record['url']).netloc,
+                                    dict(files=0, bytes=0, first_start=None, last_end=None))
+            host['files'] += 1
+            host['bytes'] += record['bytes']
+            file_start, file_end = spans[record['filename']]
+            host['first_start'] = min(file_start, host['first_start'] or file_start)
+            host['last_end'] = max(file_end, host['last_end'] or file_end)
+    for host in hosts.values():
+        # Concurrent downloads from one host overlap, so summing their seconds would understate throughput
+        host['seconds'] = host.pop('last_end') - host.pop('first_start')
+        host['mb_per_sec'] = host['bytes'] / 1e6 / max(host['seconds'], 1e-6)
+
+    failures = [record for record in files if record['status'] == 'failed']
+    skipped = sum(record['status'] in ('skipped', 'not modified') for record in files)
+    total_bytes = sum(record['bytes'] for record in files)
+    report = dict(files=files, failures=failures, hosts=hosts,
+                  seconds=seconds, bytes=total_bytes, mb_per_sec=total_bytes / 1e6 / max(seconds, 1e-6))
+    sys.stdout.write('download_files: %d downloaded, %d already present, %d failed; %.1f MB in %.1f seconds (%.1f MB/s)\n'
+                     % (len(files) - len(failures) - skipped, skipped, len(failures),
+                        total_bytes / 1e6, seconds, report['mb_per_sec']))
+    return report
+
+def pooled_session(pool_maxsize):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Calls fn(), retrying up to retries times with exponential backoff when it raises
+# RequestException or a retryable DownloadError
+def with_download_retries(url, retries, retry_delay, fn):
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except DownloadError as e:
+            if not e.retryable or attempt >= retries:
+                raise
+        except requests.exceptions.RequestException:
+            if attempt >= retries:
+                raise
+        delay = retry_delay * 2 ** attempt
+        attempt += 1
+        sys.stdout.write('Download of %s interrupted; retry %d of %d in %d seconds\n' % (url, attempt, retries, delay))
+        time.sleep(delay)
+
+class DownloadError(Exception):
+    def __init__(self, message, retryable=True):
+        super(DownloadError, self).__init__(message)
+        self.retryable = retryable
+
+def check_download_response(response):
+    if response.status_code in (200, 206):
+        return
+    # Retry server errors and throttling;  anything else won't get better by asking again
+    retryable = response.status_code >= 500 or response.status_code == 429
+    raise DownloadError('error response, code = %d, body = %s' % (response.status_code, response.text[:1000]),
+                        retryable=retryable)
+
+# Parses "bytes start-end/total" into (start, end, total).  total is None if "*".
+def parse_content_range(content_range):
+    match = re.match(r'bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)', content_range or '')
+    if not match:
+        return (None, None, None)
+    start, end, total = match.groups()
+    return (start and int(start), end and int(end), None if total == '*' else int(total))
+
+# Removes tmpname and its validator, if present
+def remove_download_tmp(tmpname):
+    for path in [tmpname, tmpname + '.validator']:
+        if os.path.exists(path):
+            os.unlink(path)
+
+# If-Range value for resuming tmpname, from the validator saved when it was started:  a strong
+# ETag, or else Last-Modified.  None if there is none for url.
+def download_if_range(url, tmpname):
+    try:
+        with open(tmpname + '.validator') as f:
+            validator = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if validator.get('url') != url:
+        return None
+    etag = validator.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return validator.get('last_modified')
+
+# Streams url into tmpname, resuming after the existing contents of tmpname if any.
+# started is a dict shared by the attempts of one download;  a tmpname that no attempt of this
+# download started is only resumed if its saved validator lets the server confirm (If-Range)
+# that the file hasn't changed, and is otherwise discarded.
+# Returns (size, headers) for the completed file, or raises DownloadError/RequestException.
+def download_to_tmp(session, url, tmpname, timeout, chunk_size, started=None):
+    started = {} if started is None else started
+    offset = os.path.getsize(tmpname) if os.path.exists(tmpname) else 0
+    # Ask for the raw bytes, so that byte offsets for resume match what is on disk
+    headers = dict(download_headers, **{'Accept-Encoding': 'identity'})
+    if offset:
+        if_range = download_if_range(url, tmpname)
+        if if_range:
+            headers['If-Range'] = if_range
+        elif not started:
+            sys.stdout.write('Discarding %s, which may be of an older version of %s\n' % (tmpname, url))
+            remove_download_tmp(tmpname)
+            offset = 0
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+    with session.get(url, timeout=timeout, headers=headers, stream=True) as response:
+        if response.status_code == 416 and offset:
+            # Range not satisfiable;  either .tmp already holds the whole file, or it's stale
+            (_, _, total) = parse_content_range(response.headers.get('Content-Range'))
+            if total == offset:
+                return (offset, response.headers)
+            remove_download_tmp(tmpname)
+            raise DownloadError('%s has %d bytes, more than the server has; restarting' % (tmpname, offset))
+        check_download_response(response)
+        if response.status_code == 206:
+            (start, _, _) = parse_content_range(response.headers.get('Content-Range'))
+            if start != offset:
+                remove_download_tmp(tmpname)
+                raise DownloadError('server resumed at byte %s instead of %d; restarting' % (start, offset))
+            sys.stdout.write('Resuming %s at byte %d\n' % (url, offset))
+            mode = 'ab'
+        else:
+            # Server ignored Range, the file changed (If-Range), or we didn't send one;  start from
+            # scratch, saving this response's validators for resuming it
+            offset = 0
+            mode = 'wb'
+            write_file_atomically(tmpname + '.validator', json.dumps({
+                'url': url, 'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}).encode())
+        started['tmp'] = True
+        expected = response.headers.get('Content-Length')
+        expected = offset + int(expected) if expected is not None else None
+        with open(tmpname, mode) as out:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                out.write(chunk)
+    size = os.path.getsize(tmpname)
+    if expected is not None and size != expected:
+        raise DownloadError('connection closed after %d of %d bytes' % (size, expected))
+    return (size, response.headers)
+
+# Extracts filename into a directory named filename without its extension, extracting into
+# a .tmp directory first and renaming it into place when complete.
+# Members are extracted in-process, streamed through buffer_size buffers, on max_workers threads
+# (default one per CPU);  zlib releases the GIL while inflating, so large archives use all cores.
+# use_subprocess=True runs the external unzip instead, e.g. for benchmarking.
+def unzip_file(filename, max_workers=None, buffer_size=1024 * 1024, use_subprocess=False):
     exdir = os.path.splitext(filename)[0]
     if os.path.exists(exdir):
         sys.stdout.write('%s already unzipped\n' % (filename))
@@ -73,97 +606,579 @@ def unzip_file(filename):
         tmpdir = exdir + '.tmp'
         shutil.rmtree(tmpdir, True)
         sys.stdout.write('Unzipping %s into %s\n' % (filename, tmpdir))
-        subprocess_check(['unzip', filename, '-d', tmpdir])
+        if use_subprocess:
+            subprocess_check(['unzip', filename, '-d', tmpdir])
+        else:
+            extract_zip(filename, tmpdir, max_workers=max_workers, buffer_size=buffer_size)
         os.rename(tmpdir, exdir)
         print('Success, created %s' % exdir)
     return exdir
 
-def gunzip_file(filename):
+def extract_zip(filename, dest, max_workers=None, buffer_size=1024 * 1024):
+    with zipfile.ZipFile(filename) as archive:
+        members = archive.infolist()
+    os.makedirs(dest, exist_ok=True)
+    for info in members:
+        if info.is_dir():
+            os.makedirs(zip_member_path(dest, info), exist_ok=True)
+    files = sorted([info for info in members if not info.is_dir()], key=lambda info: -info.file_size)
+    if not files:
+        return
+
+    # Deal members largest-first to the least loaded worker, so workers finish at about the same time
+    nworkers = min(max_workers or os.cpu_count() or 1, len(files))
+    batches = [[] for _ in range(nworkers)]
+    loads = [0] * nworkers
+    for info in files:
+        i = loads.index(min(loads))
+        batches[i].append(info)
+        loads[i] += info.file_size
+
+    def extract_batch(batch):
+        # Each worker reads through its own ZipFile, so workers don't contend for one file position
+        with zipfile.ZipFile(filename) as archive:
+            for info in batch:
+                path = zip_member_path(dest, info)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with archive.open(info) as src, open(path, 'wb') as out:
+                    shutil.copyfileobj(src, out, buffer_size)
+                mode = (info.external_attr >> 16) & 0o777
+                if mode:
+                    os.chmod(path, mode)
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                os.utime(path, (mtime, mtime))
+
+    pool = SimpleThreadPoolExecutor(nworkers)
+    for batch in batches:
+        pool.submit(extract_batch, batch)
+    pool.shutdown()
+
+# Path under dest for zip member info, ignoring absolute paths and ".." components
+def zip_member_path(dest, info):
+    parts = [part for part in info.filename.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    return os.path.join(dest, *parts)
+
+# Decompresses filename into filename without its .gz extension, via a .tmp file renamed into place.
+# Streams in-process through buffer_size buffers.  use_subprocess=True runs the external gunzip instead.
+def gunzip_file(filename, buffer_size=1024 * 1024, use_subprocess=False):
     dest = os.path.splitext(filename)[0]
     if os.path.exists(dest):
         sys.stdout.write('%s already unzipped\n' % (filename))
     else:
         tmp = dest + '.tmp'
         sys.stdout.write('gunzipping %s\n' % (filename))
-        subprocess.check_call("gunzip -c '%s' > '%s'" % (filename, tmp), shell=True)
+        with open(tmp, 'wb') as out:
+            if use_subprocess:
+                subprocess.check_call(['gunzip', '-c', filename], stdout=out)
+            else:
+                with gzip.open(filename, 'rb') as src:
+                    shutil.copyfileobj(src, out, buffer_size)
         os.rename(tmp, dest)
         sys.stdout.write('Success, created %s\n' % (dest))
-    
-class SimpleThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
-    def __init__(self, max_workers):
-        super(SimpleThreadPoolExecutor, self).__init__(max_workers=max_workers)
+    return dest
+
+# Job bookkeeping shared by SimpleThreadPoolExecutor and SimpleProcessPoolExecutor.
+# Worker exceptions are logged and counted, and raised at the end by shutdown.
+#
+# shutdown() returns results in order of submission by default (ordered=True).  Results are
+# still gathered as jobs complete, so progress and exceptions are reported as they happen
+# rather than waiting on stragglers, and put back in submission order at the end.
+# shutdown(ordered=False) skips the reordering and returns results in order of completion.
+#
+# With max_in_flight, submit blocks while max_in_flight jobs are queued or running, and
+# get_futures() holds only those in-flight jobs.  Results of completed jobs wait in a queue
+# until consumed by results_as_completed() or shutdown();  consuming them as you go (or using
+# imap) keeps memory proportional to max_in_flight rather than to the total number of jobs.
+class SimpleExecutorMixin:
+    def _init_simple(self, name, max_in_flight, shared_memory_results=False):
         self.futures = []
+        self.max_in_flight = max_in_flight
+        self._name = name
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._done = threading.Condition()
+        self._completed = collections.deque()  # (submission index, future)
+        self._in_flight = 0
+        self._submitted = 0
+        self._exception_count = 0
+        self._cancelled_count = 0
+        self._retry_count = 0
+        self._timeout_count = 0
+        self._shared_memory_results = shared_memory_results
+        # Seconds from submit to start, start to end, and submit to done of successful jobs
+        self._queue_wait = LatencyHistogram()
+        self._run = LatencyHistogram()
+        self._wall = LatencyHistogram()
+        self._timing_lock = threading.Lock()
+        self._first_submit = None
+        self._last_done = None
+        self.stats = None
 
     def submit(self, fn, *args, **kwargs):
-        future = super(SimpleThreadPoolExecutor, self).submit(fn, *args, **kwargs)
-        self.futures.append(future)
+        return self._submit(fn, args, kwargs, collect=True)
+
+    # collect=False is for jobs whose results the caller consumes itself (imap), which
+    # therefore don't go to the completed queue
+    def _submit(self, fn, args, kwargs, collect):
+        if self._slots:
+            self._slots.acquire()
+        try:
+            future = self._start(fn, args, kwargs)
+        except:
+            if self._slots:
+                self._slots.release()
+            raise
+        with self._done:
+            if self._first_submit is None:
+                self._first_submit = time.time()
+            index = self._submitted
+            self._submitted += 1
+            self._in_flight += 1
+            if collect:
+                self.futures.append(future)
+        future.add_done_callback(lambda future: self._job_done(index, future, collect))
         return future
 
+    # Runs fn as a TimedJob, whose timing is recorded when the job's future completes with its
+    # result, so attempts that failed or were abandoned (see RetryingFuture) aren't counted
+    def _start(self, fn, args, kwargs):
+        if self._shared_memory_results:
+            fn = SharedMemoryResult(fn)
+        submitted = time.time()
+        def job_done(timed_result):
+            (start, end, result) = timed_result
+            self._record_timing(submitted, start, end, time.time())
+            return from_shared_memory(result) if self._shared_memory_results else result
+        return DerivedFuture(self._start_job(TimedJob(fn), args, kwargs), job_done)
+
+    # Records timing of a successful job in fixed-size histograms, so memory stays bounded
+    # however many jobs run, and cheap enough to leave on
+    def _record_timing(self, submitted, start, end, done):
+        with self._timing_lock:
+            self._queue_wait.add(start - submitted)
+            self._run.add(end - start)
+            self._wall.add(done - submitted)
+            self._last_done = done
+
+    def _job_done(self, index, future, collect):
+        with self._done:
+            self._in_flight -= 1
+            if self._slots and collect:
+                self.futures.remove(future)
+            if collect:
+                self._completed.append((index, future))
+            self._done.notify_all()
+        if self._slots:
+            self._slots.release()
+
+    # Returns (True, result), or logs the exception and returns (False, None)
+    def _job_result(self, future):
+        try:
+            return (True, future.result())
+        except concurrent.futures.CancelledError:
+            with self._done:
+                self._cancelled_count += 1
+            return (False, None)
+        except Exception:
+            with self._done:
+                self._exception_count += 1
+            sys.stderr.write(
+                'Exception caught in %s.  Continuing until all are finished.\n' % self._name +
+                'Exception follows:\n' +
+                traceback.format_exc())
+            return (False, None)
+
     def get_futures(self):
         return self.futures
-    
-    def shutdown(self, tqdm=None):
-        exception_count = 0
+
+    # Yields (submission index, result) for collected jobs as they complete
+    def _indexed_results_as_completed(self):
+        while True:
+            with self._done:
+                while not self._completed and self._in_flight:
+                    self._done.wait()
+                if not self._completed:
+                    return
+                (index, future) = self._completed.popleft()
+            (ok, result) = self._job_result(future)
+            if ok:
+                yield (index, result)
+
+    # Yields results of submitted jobs in order of completion, including jobs submitted
+    # (e.g. from another thread) while iterating, and returns when no jobs are in flight.
+    # Jobs that raise are logged and counted, and reported by shutdown.
+    def results_as_completed(self):
+        for (_, result) in self._indexed_results_as_completed():
+            yield result
+
+    # Submits fn(item) for each item in iterable, yielding results while later items are still
+    # being submitted:  in order of iterable if ordered, otherwise in order of completion.
+    # At most max_in_flight (default 2 * max_workers) of these jobs are held at once.
+    # Jobs that raise are logged, counted, and skipped, and reported by shutdown.
+    def imap(self, fn, iterable, ordered=True):
+        limit = self.max_in_flight or 2 * self._max_workers
+        if ordered:
+            pending = collections.deque()
+            for item in iterable:
+                pending.append(self._submit(fn, (item,), {}, collect=False))
+                while len(pending) >= limit or (pending and pending[0].done()):
+                    (ok, result) = self._job_result(pending.popleft())
+                    if ok:
+                        yield result
+            while pending:
+                (ok, result) = self._job_result(pending.popleft())
+                if ok:
+                    yield result
+        else:
+            pending = set()
+            def take_completed():
+                nonlocal pending
+                (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                return done
+            for item in iterable:
+                pending.add(self._submit(fn, (item,), {}, collect=False))
+                if len(pending) >= limit:
+                    for future in take_completed():
+                        (ok, result) = self._job_result(future)
+                        if ok:
+                            yield result
+            while pending:
+                for future in take_completed():
+                    (ok, result) = self._job_result(future)
+                    if ok:
+                        yield result
+
+    # With print_stats, also prints the ExecutorStats that shutdown leaves in self.stats
+    def shutdown(self, tqdm=None, ordered=True, print_stats=False):
         results = []
-        as_completed = concurrent.futures.as_completed(self.futures)
         if tqdm is not None:
-            tqdm.reset(len(self.futures))
-        for completed in as_completed:
-            try:
-                results.append(completed.result())
-                if tqdm is not None:
-                    tqdm.update()
-            except Exception:
-                exception_count += 1
-                sys.stderr.write(
-                    'Exception caught in SimpleThreadPoolExecutor.shutdown.  Continuing until all are finished.\n' +
-                    'Exception follows:\n' +
-                    traceback.format_exc())
+            tqdm.reset(self._in_flight + len(self._completed))
+        for indexed_result in self._indexed_results_as_completed():
+            results.append(indexed_result)
+            if tqdm is not None:
+                tqdm.update()
         if tqdm is not None:
             tqdm.close()
-        super(SimpleThreadPoolExecutor, self).shutdown()
-        if exception_count:
-            raise Exception('SimpleThreadPoolExecutor failed: %d of %d raised exception' % (exception_count, len(self.futures)))
-        print('SimpleThreadPoolExecutor succeeded: all %d jobs completed' % len(self.futures))
+        if ordered:
+            results.sort(key=lambda indexed_result: indexed_result[0])
+        results = [result for (_, result) in results]
+        # Threads of timed-out jobs may never finish, so don't wait for them
+        super(SimpleExecutorMixin, self).shutdown(wait=not self._timeout_count)
+        self.stats = self.get_stats()
+        if print_stats:
+            print(self.stats)
+        if self._exception_count or self._cancelled_count:
+            raise Exception('%s failed: %d of %d raised exception%s' % (self._name, self._exception_count, self._submitted, self._summary_counts()))
+        print('%s succeeded: all %d jobs completed%s' % (self._name, self._submitted, self._summary_counts()))
         return results
 
+    # ExecutorStats for jobs completed so far
+    def get_stats(self):
+        with self._timing_lock:
+            return ExecutorStats(self._name, self._max_workers, self._queue_wait, self._run, self._wall,
+                                 self._first_submit, self._last_done)
 
-class SimpleProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
-    def __init__(self, max_workers):
-        super(SimpleProcessPoolExecutor, self).__init__(max_workers=max_workers)
-        self.futures = []
+    # e.g. " (3 retries, 1 timed out, 20 cancelled)", or "" if none
+    def _summary_counts(self):
+        counts = [(self._retry_count, 'retries'), (self._timeout_count, 'timed out'), (self._cancelled_count, 'cancelled')]
+        counts = ['%d %s' % (count, label) for (count, label) in counts if count]
+        return ' (%s)' % ', '.join(counts) if counts else ''
 
-    def submit(self, fn, *args, **kwargs):
-        future = super(SimpleProcessPoolExecutor, self).submit(fn, *args, **kwargs)
-        self.futures.append(future)
-        return future
+# Timing of successful jobs of a SimpleThreadPoolExecutor or SimpleProcessPoolExecutor, to help
+# size max_workers.  For each job, queue_wait is from submit until a worker started it (including
+# earlier attempts if retried), run is the time in the worker, and wall is from submit until the
+# result was back in the parent;  each is a dict of p50, p95, p99 and max seconds, from
+# LatencyHistograms.  jobs_per_sec and busy_fraction (run time over max_workers * elapsed) are
+# over the time from first submit to last result.
+class ExecutorStats:
+    def __init__(self, name, max_workers, queue_wait, run, wall, first_submit, last_done):
+        self.name = name
+        self.jobs = wall.count
+        self.seconds = (last_done - first_submit) if self.jobs else 0
+        self.queue_wait = queue_wait.percentiles()
+        self.run = run.percentiles()
+        self.wall = wall.percentiles()
+        self.jobs_per_sec = self.jobs / self.seconds if self.seconds else 0
+        self.busy_fraction = run.total / (max_workers * self.seconds) if self.seconds else 0
 
-    def get_futures(self):
-        return self.futures
+    def __str__(self):
+        def fmt(latencies):
+            return '/'.join('%.1f' % (latencies[p] * 1000) for p in ['p50', 'p95', 'p99'])
+        return ('%s stats: %d jobs in %.1f seconds (%.1f jobs/sec), workers %.0f%% busy\n' % (
+                    self.name, self.jobs, self.seconds, self.jobs_per_sec, self.busy_fraction * 100) +
+                '  p50/p95/p99 ms: queue wait %s, run %s, wall %s' % (fmt(self.queue_wait), fmt(self.run), fmt(self.wall)))
+
+# Histogram of latencies in seconds, in logarithmic buckets each 2**(1/16) (about 4.4%) wider
+# than the last, from 1 microsecond up to about 12 days.  Memory is fixed however many values are
+# added;  percentiles() are nearest-rank percentiles, to within a bucket.  Not thread-safe.
+class LatencyHistogram:
+    buckets_per_doubling = 16
+    min_seconds = 1e-6
+    max_bucket = 16 * 40
+
+    def __init__(self):
+        self.counts = collections.Counter()  # bucket -> count
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, seconds):
+        if seconds <= self.min_seconds:
+            bucket = 0
+        else:
+            bucket = min(self.max_bucket, 1 + int(math.log2(seconds / self.min_seconds) * self.buckets_per_doubling))
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    # Upper bound of the bucket holding the value of nearest rank p, but no more than max
+    def percentile(self, p):
+        rank = max(1, math.ceil(p / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.max, self.min_seconds * 2 ** (bucket / self.buckets_per_doubling))
+        return self.max
+
+    def percentiles(self):
+        if not self.count:
+            return {'p50': 0, 'p95': 0, 'p99': 0, 'max': 0}
+        return {'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99), 'max': self.max}
+
+# Calls fn in a worker, returning (start time, end time, result).  A class rather than a closure
+# so SimpleProcessPoolExecutor can pickle it.
+class TimedJob:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, *args, **kwargs):
+        start = time.time()
+        result = self.fn(*args, **kwargs)
+        return (start, time.time(), result)
+
+# SimpleThreadPoolExecutor options for unreliable jobs, such as API calls:
+#   timeout:  an attempt still running after timeout seconds fails with TimeoutError.  Python
+#     can't stop a thread, so the attempt keeps running in the background and its result is
+#     ignored;  shutdown() doesn't wait for it.
+#   retries:  an attempt that raises one of the exception types retry_on (which includes
+#     TimeoutError by default) is retried up to retries times, after retry_delay seconds,
+#     doubling each time.
+#   max_failures:  once max_failures jobs have failed (after retries), cancel_pending() is called,
+#     and jobs submitted later are cancelled, so a doomed batch stops early.
+# Cancelled jobs are counted, and make shutdown() raise like exceptions do.
+class SimpleThreadPoolExecutor(SimpleExecutorMixin, concurrent.futures.ThreadPoolExecutor):
+    def __init__(self, max_workers, max_in_flight=None, timeout=None, retries=0, retry_on=(Exception,),
+                 retry_delay=1, max_failures=None):
+        super(SimpleThreadPoolExecutor, self).__init__(max_workers=max_workers)
+        self._init_simple('SimpleThreadPoolExecutor', max_in_flight)
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_on = retry_on
+        self.retry_delay = retry_delay
+        self.max_failures = max_failures
+        self._failed_count = 0
+        self._cancelling = False
+        self._retrying = set()  # RetryingFutures not yet done
+
+    def _start_job(self, fn, args, kwargs):
+        if self._cancelling:
+            future = concurrent.futures.Future()
+            future.cancel()
+            future.set_running_or_notify_cancel()
+            return future
+        if self.timeout is None and not self.retries and self.max_failures is None:
+            return concurrent.futures.ThreadPoolExecutor.submit(self, fn, *args, **kwargs)
+        return RetryingFuture(self, fn, args, kwargs)
+
+    # Cancels jobs that haven't started, and jobs waiting to be retried.  Running jobs are left
+    # to finish.  Returns the number of jobs cancelled.
+    def cancel_pending(self):
+        with self._done:
+            self._cancelling = True
+            futures = list(self.futures) + list(self._retrying)
+        cancelled = sum([future.cancel() for future in futures if not future.done()])
+        sys.stderr.write('%s cancelled %d pending jobs\n' % (self._name, cancelled))
+        return cancelled
+
+    def _job_failed(self):
+        with self._done:
+            self._failed_count += 1
+            exhausted = self.max_failures is not None and self._failed_count == self.max_failures
+        if exhausted:
+            sys.stderr.write('%s reached max_failures=%d;  cancelling pending jobs\n' % (self._name, self.max_failures))
+            self.cancel_pending()
+
+    def _count(self, counter):
+        with self._done:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+# Future for a SimpleThreadPoolExecutor job with timeout, retries or max_failures.  Each attempt runs as
+# its own job on the executor;  attempts are numbered so that the late result of an attempt
+# that timed out is ignored.
+class RetryingFuture(concurrent.futures.Future):
+    def __init__(self, executor, fn, args, kwargs):
+        super().__init__()
+        self._executor = executor
+        self._fn = fn
+        self._args = args
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._attempts = 0
+        self._attempt = None  # Future of the current attempt, until it finishes
+        self._timer = None    # Timer for the current attempt's timeout, or for the next retry
+        with executor._done:
+            executor._retrying.add(self)
+        self.add_done_callback(self._discard)
+        self._start_attempt()
+
+    def _start_attempt(self):
+        with self._lock:
+            if self.done():
+                return
+            self._attempts += 1
+            self._timer = None
+            try:
+                self._attempt = concurrent.futures.ThreadPoolExecutor.submit(self._executor, self._run, self._attempts)
+            except Exception as e:
+                # e.g. the executor was shut down while waiting to retry
+                self._attempt = None
+                self.set_exception(e)
+
+    def _run(self, attempt):
+        if self._executor.timeout is not None:
+            timer = threading.Timer(self._executor.timeout, self._finish_attempt,
+                                    (attempt, TimeoutError('timed out after %g seconds' % self._executor.timeout), None))
+            timer.daemon = True
+            with self._lock:
+                self._timer = timer
+            timer.start()
+        try:
+            result = self._fn(*self._args, **self._kwargs)
+        except Exception as e:
+            self._finish_attempt(attempt, e, None)
+            return
+        self._finish_attempt(attempt, None, result)
+
+    def _finish_attempt(self, attempt, exception, result):
+        executor = self._executor
+        with self._lock:
+            if attempt != self._attempts or self.done():
+                return
+            if self._timer:
+                self._timer.cancel()
+            self._timer = None
+            self._attempt = None
+            if isinstance(exception, TimeoutError):
+                executor._count('_timeout_count')
+            if exception is None:
+                self.set_result(result)
+                return
+            if attempt <= executor.retries and isinstance(exception, executor.retry_on) and not executor._cancelling:
+                executor._count('_retry_count')
+                delay = executor.retry_delay * 2 ** (attempt - 1)
+                sys.stderr.write('%s retrying in %g seconds after %s\n' % (executor._name, delay, repr(exception)))
+                self._timer = threading.Timer(delay, self._start_attempt)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+            self.set_exception(exception)
+        executor._job_failed()
+
+    def _discard(self, future):
+        with self._executor._done:
+            self._executor._retrying.discard(self)
+
+    # Succeeds unless an attempt is running
+    def cancel(self):
+        with self._lock:
+            if self.done():
+                return self.cancelled()
+            if self._attempt is not None and not self._attempt.cancel():
+                return False
+            if self._timer:
+                self._timer.cancel()
+            super().cancel()
+            self.set_running_or_notify_cancel()
+            return True
+
+    def running(self):
+        attempt = self._attempt
+        return attempt is not None and attempt.running()
+
+# With shared_memory_results=True, large NumPy arrays, DataFrames and pyarrow Tables returned
+# by jobs come back through shared memory rather than being pickled (see SharedMemoryResult).
+class SimpleProcessPoolExecutor(SimpleExecutorMixin, concurrent.futures.ProcessPoolExecutor):
+    def __init__(self, max_workers, max_in_flight=None, shared_memory_results=False):
+        super(SimpleProcessPoolExecutor, self).__init__(max_workers=max_workers)
+        self._init_simple('SimpleProcessPoolExecutor', max_in_flight, shared_memory_results)
+
+    def _start_job(self, fn, args, kwargs):
+        return concurrent.futures.ProcessPoolExecutor.submit(self, fn, *args, **kwargs)
 
-    def shutdown(self, tqdm=None):
+    # Like map(fn, iterable), but sends items to worker processes in chunks of chunksize, one
+    # round-trip per chunk, for jobs so small that per-job pickling and IPC would dominate.
+    # Returns results in the order of iterable.  Exceptions are logged and counted per item,
+    # and raised after all items finish, like shutdown.
+    # chunksize=None picks a chunk size from the measured time of the first items:  big enough
+    # to amortize IPC, small enough to leave several chunks per worker for load balancing.
+    def map_chunked(self, fn, iterable, chunksize=None, tqdm=None):
+        items = list(iterable)
+        results = [None] * len(items)
         exception_count = 0
-        results = []
-        as_completed = concurrent.futures.as_completed(self.futures)
         if tqdm is not None:
-            tqdm.reset(len(self.futures))
-        for completed in as_completed:
-            try:
-                results.append(completed.result())
+            tqdm.reset(len(items))
+        pending = {}  # future -> (start, end) indices of chunk
+        def submit_chunk(start, end):
+            pending[self._submit(run_chunk, (fn, items[start:end]), {}, collect=False)] = (start, end)
+
+        def take_completed():
+            nonlocal exception_count
+            (done, _) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            per_item_secs = []
+            for future in done:
+                (start, end) = pending.pop(future)
+                try:
+                    (elapsed, chunk_results) = future.result()
+                    per_item_secs.append(elapsed / len(chunk_results))
+                except Exception:
+                    # The whole chunk failed, e.g. fn couldn't be pickled or a worker died
+                    chunk_results = [(False, traceback.format_exc())] * (end - start)
+                for (i, (ok, result)) in enumerate(chunk_results):
+                    if ok:
+                        results[start + i] = result
+                    else:
+                        exception_count += 1
+                        sys.stderr.write(
+                            'Exception caught in SimpleProcessPoolExecutor.map_chunked.  Continuing until all are finished.\n' +
+                            'Exception follows:\n' + result)
                 if tqdm is not None:
-                    tqdm.update()
-            except Exception:
-                exception_count += 1
-                sys.stderr.write(
-                    'Exception caught in SimpleProcessPoolExecutor.shutdown.  Continuing until all are finished.\n' +
-                    'Exception follows:\n' +
-                    traceback.format_exc())
+                    tqdm.update(len(chunk_results))
+            return per_item_secs
+
+        pos = 0
+        if chunksize is None:
+            # Probe with one item per worker, and size chunks from the first to finish
+            probes = min(self._max_workers, len(items))
+            for i in range(probes):
+                submit_chunk(i, i + 1)
+            pos = probes
+            per_item_secs = []
+            while pending and not per_item_secs:
+                per_item_secs = take_completed()
+            chunksize = auto_chunksize(min(per_item_secs or [0]), len(items) - pos, self._max_workers)
+        nchunks = 0
+        while pos < len(items):
+            submit_chunk(pos, min(pos + chunksize, len(items)))
+            pos += chunksize
+            nchunks += 1
+        while pending:
+            take_completed()
         if tqdm is not None:
             tqdm.close()
-        super(SimpleProcessPoolExecutor, self).shutdown()
         if exception_count:
-            raise Exception('SimpleProcessPoolExecutor failed: %d of %d raised exception' % (exception_count, len(self.futures)))
-        print('SimpleProcessPoolExecutor succeeded: all %d jobs completed' % len(self.futures))
+            raise Exception('SimpleProcessPoolExecutor.map_chunked failed: %d of %d raised exception' % (exception_count, len(items)))
+        print('SimpleProcessPoolExecutor.map_chunked succeeded: all %d items completed in %d chunks of up to %d' % (len(items), nchunks, chunksize))
         return results
 
     def kill(self, signal=9):
@@ -171,18 +1186,430 @@ class SimpleProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
             print('Killing %d with signal %d' % (pid, signal))
             os.kill(pid, signal)
 
+# Runs fn on each item of chunk, for SimpleProcessPoolExecutor.map_chunked.
+# Returns (elapsed seconds, [(True, result) or (False, traceback text) for each item]).
+def run_chunk(fn, chunk):
+    start = time.time()
+    results = []
+    for item in chunk:
+        try:
+            results.append((True, fn(item)))
+        except Exception:
+            results.append((False, traceback.format_exc()))
+    return (time.time() - start, results)
+
+# Chunk size for remaining items that take per_item_secs each:  aim for chunks of target_secs
+# so IPC overhead is amortized, but keep at least 4 chunks per worker so work stays balanced.
+def auto_chunksize(per_item_secs, remaining, workers, target_secs=0.1):
+    by_time = math.ceil(target_secs / per_item_secs) if per_item_secs > 0 else remaining
+    by_balance = math.ceil(remaining / (4 * workers))
+    return max(1, min(by_time, by_balance))
+
+import mmap, multiprocessing.resource_tracker, multiprocessing.shared_memory, pickle
+
+# Shared-memory transport for large results of worker processes.
+#
+# Returning a big NumPy array or DataFrame from a worker process normally costs a pickle in the
+# child, a copy through a pipe, and an unpickle in the parent.  SharedMemoryResult(fn) instead
+# copies large NumPy arrays, the NumPy columns of DataFrames, and pyarrow Tables into
+# multiprocessing.shared_memory segments in the child, and returns only small handles.
+# from_shared_memory maps the segments in the parent without copying, and unlinks them right
+# away;  the memory itself is released when the last array referring to it is garbage collected.
+#
+# Use with SimpleProcessPoolExecutor(..., shared_memory_results=True), or PrCall(SharedMemoryResult(fn), ...).
+# Results inside tuples, lists and dicts are converted too;  anything else is pickled as usual.
+#
+# Until the parent maps them, segments belong to no one, so SharedMemoryResult takes care not to
+# leak them:  it pickles the converted result itself, and unlinks its segments if that or anything
+# else fails.  Segments also stay registered with the resource tracker, which SharedMemoryResult
+# starts in the parent so that children share it;  it unlinks any the parent never maps (say,
+# from a PrCall whose value() is never called) when the parent exits.
+
+# Arrays smaller than this are cheaper to pickle than to put in their own segment
+shared_memory_min_bytes = 1024 * 1024
+
+class SharedMemoryResult:
+    def __init__(self, fn):
+        self.fn = fn
+        # Start the resource tracker now, so that children started from here on share it
+        multiprocessing.resource_tracker.ensure_running()
+
+    def __call__(self, *args, **kwargs):
+        segments = []
+        try:
+            result = PickledResult(pickle.dumps(to_shared_memory(self.fn(*args, **kwargs), segments),
+                                                protocol=pickle.HIGHEST_PROTOCOL))
+        except:
+            for name in segments:
+                unlink_shared_memory(name)
+            raise
+        return result
+
+# A result already pickled in the child, so that pickling it again to send can't fail
+class PickledResult:
+    def __init__(self, data):
+        self.data = data
+
+# Converts value, appending the name of each segment created to segments
+def to_shared_memory(value, segments):
+    if type(value) in (tuple, list):
+        return type(value)(to_shared_memory(v, segments) for v in value)
+    if type(value) is dict:
+        return {k: to_shared_memory(v, segments) for (k, v) in value.items()}
+    # Only look for types whose modules the worker has already imported
+    np = sys.modules.get('numpy')
+    pd = sys.modules.get('pandas')
+    pa = sys.modules.get('pyarrow')
+    if np and isinstance(value, np.ndarray) and value.dtype != object and value.nbytes >= shared_memory_min_bytes:
+        shared = SharedArray(value)
+    elif pd and isinstance(value, pd.DataFrame) and shared_frame_bytes(value) >= shared_memory_min_bytes:
+        shared = SharedFrame(value)
+    elif pa and isinstance(value, (pa.Table, pa.RecordBatch)) and value.nbytes >= shared_memory_min_bytes:
+        shared = SharedArrow(value)
+    else:
+        return value
+    segments.append(shared.name)
+    return shared
+
+def from_shared_memory(value):
+    if isinstance(value, PickledResult):
+        return from_shared_memory(pickle.loads(value.data))
+    if type(value) in (tuple, list):
+        return type(value)(from_shared_memory(v) for v in value)
+    if type(value) is dict:
+        return {k: from_shared_memory(v) for (k, v) in value.items()}
+    if isinstance(value, (SharedArray, SharedFrame, SharedArrow)):
+        return value.load()
+    return value
+
+# Creates a segment, lets fill(buf) write into it, and returns its name.
+# The segment is handed over to the parent, which unlinks it in map_shared_memory.
+def create_shared_memory(size, fill):
+    shm = multiprocessing.shared_memory.SharedMemory(create=True, size=max(1, size))
+    try:
+        fill(shm.buf)
+    except:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return shm.name
+
+def unlink_shared_memory(name):
+    shm = multiprocessing.shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
+
+# Maps segment name as a uint8 array of size bytes and unlinks it.  The array holds the
+# segment's mmap directly, so the mapping lasts until the array and every array viewing it are
+# garbage collected.
+# SharedMemory has no public way to hand over its mmap:  it can't be closed while NumPy holds
+# its buffer.  So this detaches the mmap through SharedMemory's _mmap and _buf attributes, as
+# they are in Python 3.8 and later, and falls back to copying the segment if they're missing.
+def map_shared_memory(name, size):
+    import numpy as np
+    shm = multiprocessing.shared_memory.SharedMemory(name=name)
+    try:
+        if isinstance(getattr(shm, '_mmap', None), mmap.mmap) and isinstance(getattr(shm, '_buf', None), memoryview):
+            view = np.frombuffer(shm._mmap, dtype=np.uint8, count=size)
+            # Detach the mmap so close() below only closes the file descriptor
+            shm._buf.release()
+            (shm._buf, shm._mmap) = (None, None)
+        else:
+            view = np.frombuffer(shm.buf, dtype=np.uint8, count=size).copy()
+        shm.close()
+    finally:
+        shm.unlink()
+    return view
+
+class SharedArray:
+    def __init__(self, array):
+        import numpy as np
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.size = array.nbytes
+        def fill(buf):
+            np.ndarray(array.shape, array.dtype, buffer=buf)[...] = array
+        self.name = create_shared_memory(self.size, fill)
+
+    def load(self):
+        return map_shared_memory(self.name, self.size).view(self.dtype).reshape(self.shape)
+
+def shared_frame_bytes(df):
+    return sum(df.iloc[:, i].nbytes for i in shared_frame_columns(df))
+
+# Positions of DataFrame columns that are plain NumPy arrays, and can go in shared memory
+def shared_frame_columns(df):
+    import numpy as np
+    return [i for (i, dtype) in enumerate(df.dtypes) if isinstance(dtype, np.dtype) and dtype != object]
+
+# Puts the NumPy columns of a DataFrame in one segment, each aligned to 64 bytes.
+# Other columns (strings, categoricals, extension types) and the index are pickled.
+# The parent gets the columns without copying, though pandas may still copy them when it
+# consolidates several columns of the same dtype into one block.
+class SharedFrame:
+    def __init__(self, df):
+        import numpy as np
+        self.index = df.index
+        self.columns = df.columns
+        self.layout = {}  # column position -> (offset, dtype, length)
+        self.other = {}   # column position -> pickled column array
+        shared = set(shared_frame_columns(df))
+        arrays = {}
+        self.size = 0
+        for i in range(len(df.columns)):
+            if i in shared:
+                arrays[i] = np.ascontiguousarray(df.iloc[:, i].to_numpy())
+                self.layout[i] = (self.size, arrays[i].dtype, len(arrays[i]))
+                self.size += (arrays[i].nbytes + 63) // 64 * 64
+            else:
+                self.other[i] = df.iloc[:, i].array
+        def fill(buf):
+            for (i, (offset, dtype, length)) in self.layout.items():
+                np.ndarray(length, dtype, buffer=buf, offset=offset)[...] = arrays[i]
+        self.name = create_shared_memory(self.size, fill)
+
+    def load(self):
+        import pandas as pd
+        view = map_shared_memory(self.name, self.size)
+        data = dict(self.other)
+        for (i, (offset, dtype, length)) in self.layout.items():
+            data[i] = view[offset:offset + length * dtype.itemsize].view(dtype)
+        df = pd.DataFrame({i: data[i] for i in range(len(self.columns))}, index=self.index, copy=False)
+        df.columns = self.columns
+        return df
+
+# Puts a pyarrow Table or RecordBatch in a segment in Arrow IPC stream format, which the
+# parent reads back with its buffers pointing into the segment.
+class SharedArrow:
+    def __init__(self, table):
+        import pyarrow as pa
+        self.is_batch = isinstance(table, pa.RecordBatch)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write(table)
+        data = sink.getvalue()
+        self.size = data.size
+        def fill(buf):
+            buf[:data.size] = memoryview(data).cast('B')
+        self.name = create_shared_memory(self.size, fill)
+
+    def load(self):
+        import pyarrow as pa
+        table = pa.ipc.open_stream(pa.py_buffer(map_shared_memory(self.name, self.size))).read_all()
+        return table.to_batches()[0] if self.is_batch else table
+
+# Future for the result of future inner, transformed by fn(result) when inner completes.
+# Cancelling it cancels inner.
+class DerivedFuture(concurrent.futures.Future):
+    def __init__(self, inner, fn):
+        super().__init__()
+        self._inner = inner
+        def inner_done(inner):
+            if inner.cancelled():
+                super(DerivedFuture, self).cancel()
+                self.set_running_or_notify_cancel()
+            elif inner.exception() is not None:
+                self.set_exception(inner.exception())
+            else:
+                try:
+                    self.set_result(fn(inner.result()))
+                except Exception as e:
+                    self.set_exception(e)
+        inner.add_done_callback(inner_done)
+
+    def cancel(self):
+        return self._inner.cancel() and super().cancel()
+
+    def running(self):
+        return self._inner.running()
+
+# with Stopwatch(name):  times a block, printing how long it took.
+#
+# Profiling is opt-in:  set Stopwatch.profile = stopwatch_profile (or pass profile=), and each
+# block is recorded there under its path of enclosing Stopwatch names, aggregating count, total,
+# mean and max time, so thousands of blocks in a nightly run can be summarized by
+# stopwatch_profile.report(), or dumped for a flame graph.  Names then work best as fixed
+# labels;  see StopwatchProfile for the limit on distinct paths.
+# Nesting follows contextvars, so each thread has its own tree, and asyncio tasks nest under
+# the Stopwatch that created them.
+#
+# Pass verbose=False, or set Stopwatch.verbose = False for all, to record without printing,
+# e.g. in hot loops.
+#
+# After the block, these fields are set, and returned as a dict by stats():
+#   seconds:  wall time
+#   cpu_seconds:  CPU time of the whole process (all threads), from time.process_time
+#   thread_cpu_seconds:  CPU time of this thread, from time.thread_time
+#   cpu_efficiency:  cpu_seconds / seconds;  well under 1 for a single-threaded stage means
+#     it's waiting on I/O
+# With resources=True (or Stopwatch.resources = True), also:
+#   peak_rss_bytes:  peak resident memory of the process so far, from resource.getrusage
+#   read_bytes, write_bytes:  bytes the process read and wrote during the block, including
+#     from page cache, pipes and sockets, from /proc/self/io (None where unavailable)
 class Stopwatch:
-    def __init__(self, name):
+    verbose = True
+    resources = False
+    profile = None
+
+    def __init__(self, name, verbose=None, profile=None, resources=None):
         self.name = name
+        if verbose is not None:
+            self.verbose = verbose
+        if resources is not None:
+            self.resources = resources
+        if profile is not None:
+            self.profile = profile
+
     def __enter__(self):
+        self.path = stopwatch_path.get() + (self.name,)
+        self._token = stopwatch_path.set(self.path)
+        if self.resources:
+            self.start_io = proc_io_bytes()
         self.start = time.time()
-        self.start_cpu = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_thread_cpu = time.thread_time()
+        return self
+
     def __exit__(self, type, value, traceback):
-        sys.stdout.write(
-            '%s took %.1f seconds (%.1f CPU)\n' 
-            % (self.name, time.time() - self.start, time.perf_counter() - self.start_cpu))
+        self.seconds = time.time() - self.start
+        self.cpu_seconds = time.process_time() - self.start_cpu
+        self.thread_cpu_seconds = time.thread_time() - self.start_thread_cpu
+        self.cpu_efficiency = self.cpu_seconds / self.seconds if self.seconds else 0
+        if self.resources:
+            self.peak_rss_bytes = peak_rss_bytes()
+            (read_bytes, write_bytes) = proc_io_bytes()
+            self.read_bytes = read_bytes - self.start_io[0] if read_bytes is not None else None
+            self.write_bytes = write_bytes - self.start_io[1] if write_bytes is not None else None
+        stopwatch_path.reset(self._token)
+        if self.profile is not None:
+            self.profile.record(self.path, self.seconds, self.cpu_seconds)
+        if self.verbose:
+            self.report()
+
+    def stats(self):
+        fields = ['seconds', 'cpu_seconds', 'thread_cpu_seconds', 'cpu_efficiency']
+        if self.resources:
+            fields += ['peak_rss_bytes', 'read_bytes', 'write_bytes']
+        return {'name': self.name, **{field: getattr(self, field) for field in fields}}
+
+    def report(self):
+        msg = '%s took %.1f seconds (%.1f CPU, %.0f%% of wall)' % (self.name, self.seconds, self.cpu_seconds, self.cpu_efficiency * 100)
+        if self.resources:
+            msg += ', peak RSS %.0f MB' % (self.peak_rss_bytes / 1e6)
+            if self.read_bytes is not None:
+                msg += ', read %.1f MB, wrote %.1f MB' % (self.read_bytes / 1e6, self.write_bytes / 1e6)
+        sys.stdout.write(msg + '\n')
         sys.stdout.flush()
-        
+
+# Peak resident memory of this process, in bytes
+def peak_rss_bytes():
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, KB elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+# (bytes read, bytes written) by this process so far, or (None, None) without /proc/self/io
+def proc_io_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return (int(fields['rchar']), int(fields['wchar']))
+    except (OSError, KeyError, ValueError):
+        return (None, None)
+
+# Names of the Stopwatches enclosing the current code
+stopwatch_path = contextvars.ContextVar('stopwatch_path', default=())
+
+# Timings of Stopwatch blocks, aggregated by path.  Memory is proportional to the number of
+# distinct paths, not the number of blocks, and paths beyond the first max_paths (say, from names
+# that include changing values) are aggregated together under overflow_path.
+class StopwatchProfile:
+    overflow_path = ('(other)',)
+
+    def __init__(self, max_paths=10000):
+        self.lock = threading.Lock()
+        self.max_paths = max_paths
+        self.timings = {}  # path -> [count, total seconds, max seconds, total CPU, max CPU]
+
+    def record(self, path, seconds, cpu_seconds):
+        with self.lock:
+            timing = self.timings.get(path)
+            if timing is None:
+                if len(self.timings) >= self.max_paths:
+                    path = self.overflow_path
+                timing = self.timings.get(path)
+                if timing is None:
+                    timing = self.timings[path] = [0, 0.0, 0.0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            timing[3] += cpu_seconds
+            timing[4] = max(timing[4], cpu_seconds)
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+
+    # Returns {path: dict of count, total, mean, max, self (total minus time in nested Stopwatches),
+    # cpu_total, cpu_mean and cpu_max}
+    def stats(self):
+        with self.lock:
+            timings = {path: list(timing) for (path, timing) in self.timings.items()}
+        stats = {}
+        for (path, (count, total, max_secs, cpu_total, cpu_max)) in timings.items():
+            stats[path] = {'count': count, 'total': total, 'mean': total / count, 'max': max_secs, 'self': total,
+                           'cpu_total': cpu_total, 'cpu_mean': cpu_total / count, 'cpu_max': cpu_max}
+        for (path, timing) in timings.items():
+            if path[:-1] in stats:
+                stats[path[:-1]]['self'] -= timing[1]
+        for path_stats in stats.values():
+            path_stats['self'] = max(0, path_stats['self'])
+        return stats
+
+    # Prints the limit paths with the most total time
+    def report(self, limit=20):
+        stats = sorted(self.stats().items(), key=lambda item: -item[1]['total'])
+        for (path, s) in stats[:limit]:
+            sys.stdout.write('%10.3f total %10.3f self %8d x %10.4f mean %10.4f max  %s\n' % (
+                s['total'], s['self'], s['count'], s['mean'], s['max'], ' > '.join(path)))
+        sys.stdout.flush()
+
+    # Collapsed stacks, one line per path of ";"-separated names followed by its self time in
+    # microseconds, as read by flamegraph.pl and speedscope
+    def collapsed_stacks(self):
+        lines = []
+        for (path, s) in sorted(self.stats().items()):
+            lines.append('%s %d\n' % (';'.join(name.replace(';', ',') for name in path), round(s['self'] * 1e6)))
+        return ''.join(lines)
+
+    # Tree of {"name", stats..., "children": [...]}, one tree for each outermost Stopwatch name
+    def to_json(self):
+        nodes = {(): {'children': []}}
+        for (path, s) in sorted(self.stats().items()):
+            for i in range(1, len(path) + 1):
+                if path[:i] not in nodes:
+                    nodes[path[:i]] = {'name': path[i - 1], 'children': []}
+                    nodes[path[:i - 1]]['children'].append(nodes[path[:i]])
+            nodes[path].update(s)
+        return nodes[()]['children']
+
+    # Writes JSON if filename ends in .json, otherwise collapsed stacks
+    def dump(self, filename):
+        with open(filename, 'w') as out:
+            if filename.endswith('.json'):
+                json.dump(self.to_json(), out, indent=1)
+            else:
+                out.write(self.collapsed_stacks())
+        sys.stdout.write('Wrote Stopwatch profile to %s\n' % filename)
+
+    def dump_at_exit(self, filename):
+        atexit.register(self.dump, filename)
+
+stopwatch_profile = StopwatchProfile()
+
+
 def sleep_until_next_period(period, offset=0):
     now = time.time()
     start_of_next_period = math.ceil((now - offset) / period) * period + offset
@@ -206,8 +1633,32 @@ def formatSecs(secs):
     days = hours / 24
     return '%.1f days' % days
 
+# StatInstance logs to stat.createlab.org.
+#
+# With background=True (the default), log() returns as soon as the entry is queued, and a
+# sender thread POSTs queued entries one after another over a persistent requests.Session
+# (the API takes one entry per POST).  If the server can't be reached or returns a server error,
+# entries are appended to spool_path instead, and replayed once every retry_secs until the server
+# is back;  entries logged meanwhile go straight to the spool.  Entries beyond max_queue also
+# go to the spool rather than block the caller.  At exit, the sender gets up to exit_flush_secs
+# to empty the queue, and anything left is spooled for the next run.
+# flush() waits until every entry queued so far has been sent or spooled.
+# The default spool is in stat_spool_dir, private to this user, and is shared by this user's
+# processes.  Spooling and replay errors are reported on stderr, never raised to log()'s caller.
+#
+# With coalesce_secs, repeats of an entry with the same (service, host, level, summary) within
+# coalesce_secs of the last one sent are held back, and at the end of the window only the latest
+# is sent, with "count" set to the number of entries it stands for.  A state (up, down, warning or
+# critical) that differs from the last state for its service and host is sent immediately, after
+# the states held back for them, so state changes are never delayed.  info and debug entries are
+# coalesced the same way, but don't count as state changes.
+stat_spool_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'stat-spool')
+
 class StatInstance:
-    def __init__(self, use_staging_server=False, api_prefix=None):
+    state_levels = ('up', 'down', 'warning', 'critical')
+
+    def __init__(self, use_staging_server=False, api_prefix=None, background=True, max_queue=10000,
+                 spool_path=None, retry_secs=60, exit_flush_secs=5, coalesce_secs=0):
         if api_prefix:
             self.api_prefix = api_prefix
         elif use_staging_server:
@@ -216,6 +1667,25 @@ class StatInstance:
             self.api_prefix = "https://stat.createlab.org"
         self.hostname = None
         self.service = None
+        self.background = background
+        self.max_queue = max_queue
+        # One spool per server, shared by this user's processes
+        self.spool_path = spool_path or os.path.join(stat_spool_dir, '%s.jsonl' % re.sub(r'\W', '_', urllib.parse.urlparse(self.api_prefix).netloc))
+        self._private_spool = not spool_path
+        self.retry_secs = retry_secs
+        self.exit_flush_secs = exit_flush_secs
+        self._session = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._sender_pid = None
+        self._queue = None
+        self._unsent = 0  # entries queued or being sent
+        self._unreachable_until = 0
+        self._last_replay = 0
+        self.coalesce_secs = coalesce_secs
+        self._windows = {}  # (service, host, level, summary) -> {"start", "count", "latest"}
+        self._states = {}   # (service, host) -> last state level
+        atexit.register(self._flush_at_exit)
 
     def get_datetime(self):
         return datetime.datetime.now(dateutil.tz.tzlocal()).isoformat()
@@ -248,18 +1718,220 @@ class StatInstance:
             }
         print('Stat.log %s %s %s %s %s' % (level, service, host, summary, details))
         sys.stdout.flush()
+        if self.coalesce_secs:
+            for post_body in self._coalesce(post_body):
+                self._send(post_body)
+        else:
+            self._send(post_body)
+
+    def _send(self, post_body):
+        if self.background:
+            self._enqueue(post_body)
+        elif not self._post(post_body):
+            self._spool([post_body])
+        else:
+            # Without a sender thread, replay entries spooled earlier once the server is back
+            self._replay_spool()
+
+    # Returns the entries to send now:  held-back entries whose window has ended or whose state
+    # was superseded, then post_body unless it repeats an entry sent within coalesce_secs
+    def _coalesce(self, post_body):
+        now = time.time()
+        (service, host, level) = (post_body['service'], post_body['host'], post_body['level'])
+        key = (service, host, level, post_body['summary'])
+        with self._lock:
+            send = self._end_windows(lambda k, window: now - window['start'] >= self.coalesce_secs, now)
+            if level in self.state_levels:
+                if self._states.get((service, host), level) != level:
+                    send += self._end_windows(lambda k, window: k[:2] == (service, host) and k[2] in self.state_levels, None)
+                self._states[(service, host)] = level
+            window = self._windows.get(key)
+            if window:
+                window['count'] += 1
+                window['latest'] = post_body
+            else:
+                self._windows[key] = {'start': now, 'count': 0, 'latest': None}
+                send.append(post_body)
+        return send
+
+    # Ends windows for which ended(key, window) is true, returning their held-back entries.
+    # If restart is a time, windows that held entries start again then, so that repeats
+    # continue to be coalesced.
+    def _end_windows(self, ended, restart):
+        send = []
+        for (key, window) in list(self._windows.items()):
+            if ended(key, window):
+                del self._windows[key]
+                if window['latest']:
+                    send.append(dict(window['latest'], count=window['count']))
+                    if restart is not None:
+                        self._windows[key] = {'start': restart, 'count': 0, 'latest': None}
+        return send
+
+    # Sends held-back entries now, e.g. before exit
+    def flush_coalesced(self):
+        with self._lock:
+            send = self._end_windows(lambda key, window: True, None)
+        for post_body in send:
+            self._send(post_body)
+
+    # POSTs post_body.  Returns False if it should be retried later, i.e. the server couldn't be
+    # reached or had an error;  entries the server rejects are reported and dropped.
+    def _post(self, post_body):
         timeoutInSecs = 20
+        if not self._session:
+            self._session = requests.Session()
         try:
-            response = requests.post(f'{self.api_prefix}/api/log',
-                                     json=post_body, timeout=timeoutInSecs)
-            if response.status_code != 200:
-                sys.stderr.write(f'POST to {self.api_prefix}/api/log failed with status code {response.status_code} and response {response.text}')
-                sys.stderr.flush()
+            response = self._session.post(f'{self.api_prefix}/api/log',
+                                          json=post_body, timeout=timeoutInSecs)
+        except requests.exceptions.RequestException as e:
+            sys.stderr.write(f'POST to {self.api_prefix}/api/log failed: {repr(e)}\n')
+            sys.stderr.flush()
+            return False
+        if response.status_code != 200:
+            sys.stderr.write(f'POST to {self.api_prefix}/api/log failed with status code {response.status_code} and response {response.text}\n')
+            sys.stderr.flush()
+            return response.status_code < 500
+        return True
+
+    def _enqueue(self, post_body):
+        with self._lock:
+            if self._sender_pid != os.getpid():
+                # First entry, or first in a forked child, which doesn't inherit the sender thread
+                self._sender_pid = os.getpid()
+                self._queue = queue.Queue(self.max_queue)
+                self._unsent = 0
+                threading.Thread(target=self._sender, args=(self._queue,), daemon=True).start()
+            try:
+                self._queue.put_nowait(post_body)
+                self._unsent += 1
                 return
-        except requests.exceptions.RequestException:
-            sys.stderr.write(f'POST to {self.api_prefix}/api/log timed out')
+            except queue.Full:
+                pass
+        self._spool([post_body])
+
+    def _sender(self, entries):
+        while True:
+            try:
+                post_body = entries.get(timeout=min(self.retry_secs, self.coalesce_secs or self.retry_secs))
+            except queue.Empty:
+                try:
+                    self._send_ended_windows()
+                    self._replay_spool()
+                except Exception:
+                    sys.stderr.write('Stat sender failed:\n' + traceback.format_exc())
+                    sys.stderr.flush()
+                continue
+            try:
+                if time.time() < self._unreachable_until or not self._post(post_body):
+                    self._unreachable_until = max(self._unreachable_until, time.time() + self.retry_secs)
+                    self._spool([post_body])
+                else:
+                    self._replay_spool()
+            except Exception:
+                sys.stderr.write('Stat sender failed:\n' + traceback.format_exc())
+                sys.stderr.flush()
+            with self._lock:
+                self._unsent -= 1
+                self._idle.notify_all()
+
+    # Waits up to timeout seconds (forever if None) for queued entries to be sent or spooled.
+    # Returns True if the queue emptied.
+    def flush(self, timeout=None):
+        with self._lock:
+            if self._sender_pid != os.getpid():
+                return True
+            return self._idle.wait_for(lambda: self._unsent == 0, timeout)
+
+    # Sends held-back entries whose window has ended, if no further log() call did
+    def _send_ended_windows(self):
+        now = time.time()
+        with self._lock:
+            send = self._end_windows(lambda key, window: now - window['start'] >= self.coalesce_secs, now)
+        for post_body in send:
+            self._send(post_body)
+
+    def _flush_at_exit(self):
+        self.flush_coalesced()
+        if self._sender_pid != os.getpid() or self.flush(self.exit_flush_secs):
+            return
+        left = []
+        while True:
+            try:
+                left.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        sys.stderr.write(f'Stat spooling {len(left)} unsent entries to {self.spool_path}\n')
+        self._spool(left)
+
+    def _spool(self, entries):
+        lines = []
+        for entry in entries:
+            try:
+                lines.append(json.dumps(entry))
+            except (TypeError, ValueError) as e:
+                sys.stderr.write(f'Stat dropping entry that can\'t be spooled: {repr(e)}\n')
+        self._spool_lines(lines)
+
+    def _spool_lines(self, lines):
+        if not lines:
+            return
+        try:
+            if not self._spool_dir_ok():
+                raise OSError(f'{os.path.dirname(self.spool_path)} is not private to this user')
+            with open(self.spool_path, 'a') as spool:
+                spool.write(''.join(line + '\n' for line in lines))
+        except OSError as e:
+            sys.stderr.write(f'Stat dropping {len(lines)} entries that could not be spooled to {self.spool_path}: {repr(e)}\n')
             sys.stderr.flush()
 
+    # The default spool lives in a directory only this user can write, so no one else can replace
+    # it or plant a symlink there
+    def _spool_dir_ok(self):
+        return not self._private_spool or private_cache_dir(os.path.dirname(self.spool_path))
+
+    # Sends spooled entries, at most once per retry_secs.  The spool is renamed first, so other
+    # processes sharing it don't replay the same entries;  lines that don't parse or still can't be
+    # sent are spooled again.
+    def _replay_spool(self):
+        if (time.time() < max(self._last_replay + self.retry_secs, self._unreachable_until) or
+                not os.path.exists(self.spool_path) or not self._spool_dir_ok()):
+            return
+        self._last_replay = time.time()
+        replaying = '%s.replay-%d' % (self.spool_path, os.getpid())
+        try:
+            os.rename(self.spool_path, replaying)
+            with open(replaying) as f:
+                pending = collections.deque(line.rstrip('\n') for line in f if line.strip())
+        except OSError as e:
+            if not isinstance(e, FileNotFoundError):
+                sys.stderr.write(f'Stat could not read spool {self.spool_path}: {repr(e)}\n')
+            return
+        (total, sent, keep) = (len(pending), 0, [])
+        try:
+            while pending:
+                try:
+                    entry = json.loads(pending[0])
+                except ValueError:
+                    sys.stderr.write(f'Stat skipping spooled entry that doesn\'t parse: {pending[0]!r}\n')
+                    keep.append(pending.popleft())
+                    continue
+                if not self._post(entry):
+                    self._unreachable_until = time.time() + self.retry_secs
+                    break
+                pending.popleft()
+                sent += 1
+        except Exception:
+            sys.stderr.write('Stat spool replay failed:\n' + traceback.format_exc())
+        finally:
+            self._spool_lines(keep + list(pending))
+            try:
+                os.remove(replaying)
+            except OSError:
+                pass
+        sys.stderr.write(f'Stat replayed {sent} of {total} spooled entries\n')
+        sys.stderr.flush()
+
     def info(self, summary, details=None, payload={}, host=None, service=None, shortname=None):
         self.log(service, 'info', summary, details=details, payload=payload, host=host, shortname=shortname)
 
@@ -288,40 +1960,23 @@ Stat = StatInstance()
 
 class ThCall(threading.Thread):
     def __init__(self, func, *args, **kwargs):
-        self._exc_info = None
         self._output = {}
         def runner():
-            try:
-                retval = func(*args, **kwargs)
-            except Exception as e:
-                print(f'ThCall is relaying child exception {repr(e)} to parent', file=sys.stderr)
-                sys.stderr.flush()
-                self._output = {
-                    "exception": e,
-                    "traceback": traceback.format_exc()
-                }
-                return
-            self._output = {"success": retval}
+            self._output = call_and_relay('ThCall', func, args, kwargs)
         super().__init__(target=runner)
         self.start()
     
     def value(self):
         if self.is_alive():
             self.join()
-        if "exception" in self._output:
-            e = self._output["exception"]
-            print(f'ThCall is raising child exception in parent thread: {repr(e)}', file=sys.stderr)
-            print(f'Child traceback: {self._output["traceback"]}', file=sys.stderr)
-            sys.stderr.flush()
-            raise e
-        else:
-            return self._output["success"]
+        return relayed_value('ThCall', 'thread', self._output)
 
 import multiprocessing, sys, traceback
 
 # PrCall(func, *args, **kwargs) calls func(*args, **kwargs) in a separate process
 # value() waits for func to complete and returns its value.
 # If child raises an exception, value() will raise the same exception in the parent.
+# PrCall(SharedMemoryResult(func), *args, **kwargs) returns large arrays through shared memory.
 
 class PrCall(multiprocessing.Process):
     def __init__(self, func, *args, **kwargs):
@@ -329,48 +1984,221 @@ class PrCall(multiprocessing.Process):
         self._queue = multiprocessing.Queue()
         self._output = {}
         def runner():
-            try:
-                retval = func(*args, **kwargs)
-            except Exception as e:
-                print(f'PrCall is relaying child exception {repr(e)} to parent', file=sys.stderr)
-                sys.stderr.flush()
-                self._queue.put({
-                    "exception": e,
-                    "traceback": traceback.format_exc()
-                })
-                return
-            self._queue.put({"success": retval})
+            self._queue.put(call_and_relay('PrCall', func, args, kwargs))
         super().__init__(target=runner)
         self.start()
     
     def value(self):
-        if self.is_alive():
-            self.join()
-        if self._output == {}:
-            self._output = self._queue.get()
-        if "exception" in self._output:
-            e = self._output["exception"]
-            print(f'PrCall is raising child exception in parent process: {repr(e)}', file=sys.stderr)
-            print(f'Child traceback: {self._output["traceback"]}', file=sys.stderr)
-            sys.stderr.flush()
-            raise e
-        else:
-            return self._output["success"]
+        # Read the queue before joining:  a child with a large return value can't exit until
+        # its queue has been drained
+        while self._output == {}:
+            try:
+                self._output = self._queue.get(timeout=1)
+            except queue.Empty:
+                if not self.is_alive():
+                    try:
+                        self._output = self._queue.get(timeout=1)
+                    except queue.Empty:
+                        raise Exception(f'PrCall child exited with code {self.exitcode} without returning a value')
+            if "success" in self._output:
+                self._output["success"] = from_shared_memory(self._output["success"])
+        self.join()
+        return relayed_value('PrCall', 'process', self._output)
+
+# Calls func(*args, **kwargs), returning {"success": value}, or {"exception": e, "traceback": text}
+# for the parent to raise
+def call_and_relay(name, func, args, kwargs):
+    try:
+        return {"success": func(*args, **kwargs)}
+    except Exception as e:
+        print(f'{name} is relaying child exception {repr(e)} to parent', file=sys.stderr)
+        sys.stderr.flush()
+        return {
+            "exception": e,
+            "traceback": traceback.format_exc()
+        }
+
+def relayed_value(name, kind, output):
+    if "exception" in output:
+        e = output["exception"]
+        print(f'{name} is raising child exception in parent {kind}: {repr(e)}', file=sys.stderr)
+        print(f'Child traceback: {output["traceback"]}', file=sys.stderr)
+        sys.stderr.flush()
+        raise e
+    else:
+        return output["success"]
+
+# call_async(func, *args, kind='thread', **kwargs) is like ThCall(func, *args, **kwargs), or
+# PrCall with kind='process', but runs func on a persistent pool instead of starting a new
+# thread or process for each call.  Calls in a loop then skip process startup and module imports.
+# value() waits for func to complete and returns its value, relaying exceptions like ThCall and PrCall.
+#
+# The pools are created on first use, with async_pool_workers workers each.  Unlike ThCall and
+# PrCall, at most that many calls run at once;  the rest wait their turn.  With kind='process',
+# func and its arguments must be picklable, as for SimpleProcessPoolExecutor.
+
+async_pool_workers = {'thread': 32, 'process': os.cpu_count()}
+async_pools = {}
+async_pools_lock = threading.Lock()
+
+def call_async(func, *args, kind='thread', **kwargs):
+    pool = async_pool(kind)
+    return PooledCall(kind, pool, pool.submit(call_and_relay, 'call_async', func, args, kwargs))
+
+# The pool for kind, creating it if needed.  A forked child creates its own pools rather than
+# using its parent's.
+def async_pool(kind):
+    with async_pools_lock:
+        (pid, pool) = async_pools.get(kind, (None, None))
+        if pid != os.getpid():
+            if kind == 'thread':
+                pool = concurrent.futures.ThreadPoolExecutor(async_pool_workers[kind])
+            elif kind == 'process':
+                # Workers share this process's resource tracker, for SharedMemoryResult
+                multiprocessing.resource_tracker.ensure_running()
+                pool = concurrent.futures.ProcessPoolExecutor(async_pool_workers[kind])
+            else:
+                raise Exception(f'call_async: kind must be "thread" or "process", not {repr(kind)}')
+            async_pools[kind] = (os.getpid(), pool)
+        return pool
+
+class PooledCall:
+    def __init__(self, kind, pool, future):
+        self.kind = kind
+        self._pool = pool
+        self._future = future
+
+    def value(self):
+        try:
+            output = self._future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died;  start a fresh pool for later calls
+            with async_pools_lock:
+                if async_pools.get(self.kind, (None, None))[1] is self._pool:
+                    del async_pools[self.kind]
+            raise
+        if self.kind == 'process' and "success" in output:
+            output["success"] = from_shared_memory(output["success"])
+        return relayed_value('call_async', self.kind, output)
+
+# exec_ipynb(filename_or_url) runs the code cells of a notebook in the caller's globals.
+#
+# Like __pycache__ for modules, the extracted source and marshalled code are cached in
+# exec_ipynb_cache_dir, keyed by a hash of the notebook's contents, so a cache hit skips parsing
+# the JSON and compiling.  The code is compiled with the cached source's filename, which is
+# stable per hash, so tracebacks show the notebook's lines.
+# Cached code is executed, so the cache lives under the user's own cache directory, and is
+# only used if that directory belongs to this user and no one else can write to it.
+# Entries unused for exec_ipynb_cache_max_age_secs are removed whenever a new one is written.
+exec_ipynb_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'exec_ipynb')
+exec_ipynb_cache_max_age_secs = 30 * 86400
 
 def exec_ipynb(filename_or_url):
-    nb = (requests.get(filename_or_url).json() if re.match(r'https?:', filename_or_url) else json.load(open(filename_or_url)))
+    code = ipynb_code(filename_or_url)
+    globals = inspect.currentframe().f_back.f_globals
+    exec(code, globals)
+
+# Compiled code of the code cells of a notebook, from exec_ipynb_cache_dir if possible
+def ipynb_code(filename_or_url):
+    if re.match(r'https?:', filename_or_url):
+        contents = requests.get(filename_or_url).content
+    else:
+        with open(filename_or_url, 'rb') as f:
+            contents = f.read()
+    name = re.sub(r'[^\w.-]', '_', os.path.basename(urllib.parse.urlparse(filename_or_url).path))
+    base = os.path.join(exec_ipynb_cache_dir, '%s-%s' % (name, hashlib.sha256(contents).hexdigest()[:16]))
+    src_path = base + '.py'
+    # Marshalled code is specific to the Python version
+    code_path = '%s.%s.marshal' % (base, sys.implementation.cache_tag)
+    cache_ok = private_cache_dir(exec_ipynb_cache_dir)
+    if not cache_ok:
+        sys.stderr.write('exec_ipynb: not caching in %s, which is not private to this user\n' % exec_ipynb_cache_dir)
+    if cache_ok and os.path.exists(src_path):
+        try:
+            with open(code_path, 'rb') as f:
+                code = marshal.load(f)
+            # Mark the entry used, so it isn't pruned
+            for path in (src_path, code_path):
+                os.utime(path)
+            return code
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+    src = ipynb_source(json.loads(contents))
+    code = compile(src, src_path, 'exec')
+    if cache_ok:
+        prune_ipynb_cache()
+        try:
+            write_file_atomically(src_path, src.encode('utf-8'))
+            write_file_atomically(code_path, marshal.dumps(code))
+        except OSError as e:
+            sys.stderr.write('exec_ipynb: could not cache %s: %s\n' % (filename_or_url, e))
+    return code
+
+# Removes files in exec_ipynb_cache_dir unused for exec_ipynb_cache_max_age_secs, including
+# temporary files left by writers that died
+def prune_ipynb_cache():
+    oldest = time.time() - exec_ipynb_cache_max_age_secs
+    try:
+        entries = list(os.scandir(exec_ipynb_cache_dir))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < oldest:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+# Creates dirname (mode 0700) if needed, and returns whether it is owned by this user and not
+# writable by group or others, so files in it can be trusted
+def private_cache_dir(dirname):
+    try:
+        os.makedirs(dirname, mode=0o700, exist_ok=True)
+        st = os.stat(dirname)
+    except OSError:
+        return False
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+# Importer for notebooks:  with a notebook foo.ipynb (or foo-bar.ipynb for foo_bar) on sys.path,
+# "import foo_ipynb" loads it as a module, running its code cells once per process like any import,
+# with code cached as by exec_ipynb.  importlib.reload and reload_module rerun the notebook,
+# picking up changes.  Installed when utils is imported;  modules found by the usual finders
+# take precedence.
+class IpynbFinder(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        if not fullname.endswith('_ipynb'):
+            return None
+        name = fullname.rpartition('.')[2][:-len('_ipynb')]
+        for dir in (path or sys.path):
+            for candidate in sorted({name, name.replace('_', '-')}):
+                filename = os.path.join(dir or os.getcwd(), candidate + '.ipynb')
+                if os.path.isfile(filename):
+                    return importlib.util.spec_from_file_location(fullname, filename, loader=IpynbLoader())
+        return None
+
+class IpynbLoader(importlib.abc.Loader):
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        exec(ipynb_code(module.__spec__.origin), module.__dict__)
+
+def install_ipynb_importer():
+    if not any(isinstance(finder, IpynbFinder) for finder in sys.meta_path):
+        sys.meta_path.append(IpynbFinder())
+
+install_ipynb_importer()
+
+def ipynb_source(nb):
     if(nb['nbformat'] >= 4):
         src = [''.join(cell['source']) for cell in nb['cells'] if cell['cell_type'] == 'code']
     else:
         src = [''.join(cell['input']) for cell in nb['worksheets'][0]['cells'] if cell['cell_type'] == 'code']
+    return '\n\n\n'.join(src)
 
-    tmpname = '/tmp/%s-%s-%d.py' % (os.path.basename(filename_or_url),
-                                    datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'),
-                                    os.getpid())
-    src = '\n\n\n'.join(src)
-    open(tmpname, 'w').write(src)
-    code = compile(src, tmpname, 'exec')
-    globals = inspect.stack()[1][0].f_globals
-    exec(code, globals)
-
-
+# Writes data to filename via a temporary file, so readers never see it partly written
+def write_file_atomically(filename, data):
+    tmpname = '%s.tmp-%d-%d' % (filename, os.getpid(), threading.get_ident())
+    with open(tmpname, 'wb') as f:
+        f.write(data)
+    os.replace(tmpname, filename)